@@ -0,0 +1,10 @@
+#!/usr/bin/env bash
+
+set -exuo pipefail
+
+cd .travis/tools/ci_release_publisher
+pip install -r requirements.txt
+# Fails on any failed command, broken release state or a phase making noticeably more requests than it used to
+MAX_REQUESTS="--max-requests store=24 --max-requests collect=22 --max-requests cleanup=70 --max-requests publish=140 --max-requests deploy=185 --max-requests gc=420"
+python ./benchmark.py --latency 0.01 commands --jobs 2 $MAX_REQUESTS --script-args "--request-rate 100"
+python ./benchmark.py --latency 0.01 commands --jobs 2 --deploy $MAX_REQUESTS --script-args "--request-rate 100"
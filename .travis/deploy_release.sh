@@ -2,16 +2,29 @@
 
 set -exuo pipefail
 
+GITHUB_PAGES_URL="https://${TRAVIS_REPO_SLUG%%/*}.github.io/${TRAVIS_REPO_SLUG#*/}"
+
+mkdir -p content/ci content/pages
+
 cd .travis/tools/ci_release_publisher
 pip install -r requirements.txt
-mkdir ./deploy
-python ./ci_release_publisher.py collect ./deploy
-python ./ci_release_publisher.py cleanup
-python ./ci_release_publisher.py publish --latest-release \
-                                         --latest-release-prerelease \
-                                         --numbered-release \
-                                         --numbered-release-keep-count 3 \
-                                         --numbered-release-prerelease \
-                                         --tag-release \
-                                         --tag-release-draft \
-                                         ./deploy
+python ./ci_release_publisher.py deploy --latest-release \
+                                        --latest-release-prerelease \
+                                        --numbered-release \
+                                        --numbered-release-keep-count 3 \
+                                        --numbered-release-prerelease \
+                                        --tag-release \
+                                        --tag-release-draft \
+                                        --release-index-json ../../../content/ci/releases.json \
+                                        --release-index-page ../../../content/pages/ci-builds.en.md \
+                                        --release-index-url "$GITHUB_PAGES_URL/ci/releases.json"
+cd -
+
+# Build the site with the updated release index and publish it on GitHub Pages
+pip install pelican==3.7.1 markdown==2.6.11 ghp-import==0.5.5
+pelican content -o output -s pelicanconf.py
+ghp-import -n -m "Update the CI builds page" -b gh-pages output
+# Don't leak the token into the log
+set +x
+git push -fq "https://${GITHUB_ACCESS_TOKEN}@github.com/${TRAVIS_REPO_SLUG}.git" gh-pages:gh-pages > /dev/null 2>&1
+set -x
@@ -0,0 +1,742 @@
+import argparse
+import datetime
+import hashlib
+import http.server
+import json
+import os
+import random
+import re
+import shlex
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import ci_release_publisher
+
+# Benchmarks of ci_release_publisher.py running against local fake API servers, so that they can be run without
+# touching the real services and with a repository of any size we want.
+
+# A fake of the Travis-CI API v3 endpoints used by ci_release_publisher.py, seeded with builds of several branches.
+class FakeTravis:
+    def __init__(self, repo_slug, build_count, branch_count, unfinished_count, seed=0):
+        self.repo_slug = repo_slug
+        rnd = random.Random(seed)
+        branches = ['master'] + ['feature-{}'.format(i) for i in range(1, branch_count)]
+        now = datetime.datetime(2018, 1, 1)
+        self.builds = []
+        for number in range(1, build_count + 1):
+            unfinished = number > build_count - unfinished_count
+            event_type = rnd.choice(['push', 'push', 'push', 'pull_request', 'cron'])
+            self.builds.append({
+                '@type': 'build',
+                'id': 100000 + number,
+                'number': str(number),
+                'state': 'started' if unfinished else rnd.choice(['passed', 'passed', 'failed', 'errored']),
+                'event_type': event_type,
+                'duration': None if unfinished else rnd.randint(60, 3600),
+                'started_at': (now + datetime.timedelta(minutes=number)).isoformat() + 'Z',
+                'finished_at': None if unfinished else (now + datetime.timedelta(minutes=number + 30)).isoformat() + 'Z',
+                'branch': {'@type': 'branch', 'name': rnd.choice(branches)},
+                'repository': {'@type': 'repository', 'id': 1, 'slug': repo_slug},
+                'commit': {'@type': 'commit', 'sha': '{:040x}'.format(rnd.getrandbits(160)), 'message': 'Commit message of build #{}'.format(number)},
+                'jobs': self._jobs(number, 5, 'started' if unfinished else 'passed'),
+            })
+
+    # Returns `count` jobs of a build in the first stage followed by a job in the second, deploy, stage
+    def _jobs(self, build_number, count, state):
+        return [{
+            '@type': 'job',
+            'id': 1000000 + build_number * 100 + j,
+            'number': '{}.{}'.format(build_number, j),
+            'state': state if j <= count else 'created',
+            'stage': {'@type': 'stage', 'number': 1 if j <= count else 2, 'name': 'Build' if j <= count else 'Deploy'},
+        } for j in range(1, count + 2)]
+
+    # Sets the state of a job of a build, e.g. to make it finished
+    def set_job_state(self, build, job_number, state):
+        for job in build['jobs']:
+            if job['number'] == '{}.{}'.format(build['number'], job_number):
+                job['state'] = state
+
+    # Adds a new unfinished build of a branch, making it the branch's last build
+    def add_build(self, branch, job_count=5):
+        number = len(self.builds) + 1
+        self.builds.append({
+            '@type': 'build',
+            'id': 100000 + number,
+            'number': str(number),
+            'state': 'started',
+            'event_type': 'push',
+            'duration': None,
+            'started_at': (datetime.datetime(2018, 1, 1) + datetime.timedelta(minutes=number)).isoformat() + 'Z',
+            'finished_at': None,
+            'branch': {'@type': 'branch', 'name': branch},
+            'repository': {'@type': 'repository', 'id': 1, 'slug': self.repo_slug},
+            'commit': {'@type': 'commit', 'sha': '{:040x}'.format(number), 'message': 'Commit message of build #{}'.format(number)},
+            'jobs': self._jobs(number, job_count, 'started'),
+        })
+        return self.builds[-1]
+
+    def _builds(self, query):
+        builds = self.builds
+        if 'branch.name' in query:
+            builds = [b for b in builds if b['branch']['name'] == query['branch.name']]
+        if 'build.state' in query:
+            builds = [b for b in builds if b['state'] in query['build.state'].split(',')]
+        if 'build.event_type' in query:
+            builds = [b for b in builds if b['event_type'] in query['build.event_type'].split(',')]
+        if query.get('sort_by') == 'finished_at:desc':
+            # null comes first, just like on Travis-CI
+            builds = [b for b in builds if b['finished_at'] is None] + sorted([b for b in builds if b['finished_at'] is not None], key=lambda b: b['finished_at'], reverse=True)
+        offset = int(query.get('offset', 0))
+        limit = min(int(query.get('limit', 25)), 100)
+        return {
+            '@type': 'builds',
+            '@pagination': {'count': len(builds), 'offset': offset, 'limit': limit},
+            'builds': builds[offset:offset + limit],
+        }
+
+    def handle(self, method, path, query, headers, body):
+        if method == 'POST' and path == '/auth/github':
+            return 200, {}, {'access_token': 'fake-travis-token'}
+        repo = '/repo/{}'.format(urllib.parse.quote(self.repo_slug, safe=''))
+        if method == 'GET' and path == '{}/builds'.format(repo):
+            return 200, {}, self._builds(query)
+        if method == 'GET' and path.startswith('{}/branch/'.format(repo)):
+            branch = urllib.parse.unquote(path[len('{}/branch/'.format(repo)):])
+            builds = [b for b in self.builds if b['branch']['name'] == branch]
+            return 200, {}, {'@type': 'branch', 'name': branch, 'last_build': builds[-1] if builds else None}
+        match = re.fullmatch('/build/([0-9]+)/jobs', path)
+        if method == 'GET' and match:
+            builds = [b for b in self.builds if b['id'] == int(match.group(1))]
+            if builds:
+                return 200, {}, {'@type': 'jobs', 'jobs': builds[0]['jobs']}
+        return 404, {}, {'error_type': 'not_found'}
+
+# A fake of the GitHub Releases API endpoints used by ci_release_publisher.py, including the asset uploads and downloads,
+# seeded with releases of the builds of a fake Travis-CI. Like GitHub, it counts requests against a rate limit.
+# The repository has all branches of the builds but the last `deleted_branch_count` ones.
+class FakeGitHub:
+    def __init__(self, repo_slug, travis, release_count, assets_per_release, asset_size, rate_limit=0, rate_limit_window=3600, deleted_branch_count=0, seed=0):
+        self.repo_slug = repo_slug
+        self.branches = sorted(set(build['branch']['name'] for build in travis.builds), key=lambda branch: (branch != 'master', branch))
+        self.branches = self.branches[:len(self.branches) - deleted_branch_count]
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+        self._rate_limit_used = 0
+        self._rate_limit_reset = time.time() + rate_limit_window
+        self.releases = {}
+        self.assets = {}
+        self.tags = set()
+        # Other references than tags, e.g. the leases of latest releases, and the commits they point to
+        self.refs = {}
+        self.commits = {}
+        self._next_id = 1
+        self._lock = threading.Lock()
+        rnd = random.Random(seed)
+        # All seeded assets share the same contents, so that a large repository doesn't take up much memory
+        data = bytes(asset_size)
+        latest = {}
+        for build in travis.builds:
+            if len(self.releases) + len(latest) >= release_count:
+                break
+            if build['finished_at'] is None:
+                continue
+            branch = build['branch']['name']
+            if rnd.random() < 0.7:
+                release = self._create_release('ci-{}-{}'.format(branch, build['number']), build['commit']['sha'], False)
+            else:
+                release = self._create_release('ci-{}-{}-1'.format(branch, build['number']), build['commit']['sha'], True)
+            for i in range(assets_per_release):
+                self._create_asset(release, 'artifact-{}.bin'.format(i), data)
+            latest[branch] = build
+        for branch, build in latest.items():
+            release = self._create_release('ci-{}-latest'.format(branch), build['commit']['sha'], False)
+            for i in range(assets_per_release):
+                self._create_asset(release, 'artifact-{}.bin'.format(i), data)
+
+    def _create_release(self, tag_name, target_commitish, draft, name='', body='', prerelease=False):
+        release = {
+            'id': self._next_id,
+            'tag_name': tag_name,
+            'target_commitish': target_commitish,
+            'name': name,
+            'body': body,
+            'draft': draft,
+            'prerelease': prerelease,
+            'created_at': (datetime.datetime(2018, 1, 1) + datetime.timedelta(seconds=self._next_id)).isoformat() + 'Z',
+            'published_at': None,
+            'assets': [],
+        }
+        self._next_id += 1
+        self.releases[release['id']] = release
+        if not draft:
+            release['published_at'] = release['created_at']
+            self.tags.add(tag_name)
+        return release
+
+    def _create_asset(self, release, name, data):
+        asset = {
+            'id': self._next_id,
+            'release_id': release['id'],
+            'name': name,
+            'label': '',
+            'state': 'uploaded',
+            'content_type': 'application/octet-stream',
+            'size': len(data),
+            'download_count': 0,
+            'data': data,
+        }
+        self._next_id += 1
+        self.assets[asset['id']] = asset
+        release['assets'].append(asset['id'])
+        return asset
+
+    def _release_json(self, base_url, release):
+        attributes = {k: v for k, v in release.items() if k != 'assets'}
+        attributes['url'] = '{}/repos/{}/releases/{}'.format(base_url, self.repo_slug, release['id'])
+        attributes['assets_url'] = '{}/assets'.format(attributes['url'])
+        attributes['upload_url'] = '{}/assets{{?name,label}}'.format(attributes['url'])
+        attributes['html_url'] = 'https://github.com/{}/releases/tag/{}'.format(self.repo_slug, release['tag_name'])
+        attributes['assets'] = [self._asset_json(base_url, self.assets[asset_id]) for asset_id in release['assets']]
+        return attributes
+
+    def _asset_json(self, base_url, asset):
+        attributes = {k: v for k, v in asset.items() if k not in ('data', 'release_id')}
+        attributes['url'] = '{}/repos/{}/releases/assets/{}'.format(base_url, self.repo_slug, asset['id'])
+        attributes['browser_download_url'] = attributes['url']
+        return attributes
+
+    @staticmethod
+    def _page(base_url, path, query, items):
+        per_page = min(int(query.get('per_page', 30)), 100)
+        page = int(query.get('page', 1))
+        headers = {}
+        if page * per_page < len(items):
+            headers['Link'] = '<{}{}?per_page={}&page={}>; rel="next"'.format(base_url, path, per_page, page + 1)
+        return headers, items[(page - 1) * per_page:page * per_page]
+
+    @staticmethod
+    def _error(status, message):
+        return status, {}, {'message': message}
+
+    def handle(self, method, path, query, headers, body):
+        with self._lock:
+            now = time.time()
+            if now >= self._rate_limit_reset:
+                self._rate_limit_used = 0
+                self._rate_limit_reset = now + self.rate_limit_window
+            rate_limit_headers = {}
+            if self.rate_limit:
+                rate_limit_headers = {
+                    'X-RateLimit-Limit': str(self.rate_limit),
+                    'X-RateLimit-Remaining': str(max(self.rate_limit - self._rate_limit_used, 0)),
+                    'X-RateLimit-Reset': str(int(self._rate_limit_reset)),
+                }
+                if self._rate_limit_used >= self.rate_limit:
+                    return 403, rate_limit_headers, {'message': 'API rate limit exceeded.'}
+            status, response_headers, response = self._handle(method, path, query, headers, body)
+            # Just like on GitHub, conditional requests that are answered with 304 don't count against the rate limit
+            if status != 304:
+                self._rate_limit_used += 1
+                if self.rate_limit:
+                    rate_limit_headers['X-RateLimit-Remaining'] = str(max(self.rate_limit - self._rate_limit_used, 0))
+            response_headers.update(rate_limit_headers)
+            return status, response_headers, response
+
+    def _handle(self, method, path, query, headers, body):
+        base_url = 'http://{}'.format(headers['Host'])
+        repo = '/repos/{}'.format(self.repo_slug)
+        if not path.startswith(repo + '/'):
+            return self._error(404, 'Not Found')
+        path = path[len(repo):]
+        if path == '/releases' and method == 'GET':
+            releases = sorted(self.releases.values(), key=lambda r: r['id'], reverse=True)
+            response_headers, page = self._page(base_url, repo + path, query, releases)
+            response = [self._release_json(base_url, r) for r in page]
+            etag = '"{}"'.format(hashlib.sha256(json.dumps(response, sort_keys=True).encode()).hexdigest()[:32])
+            response_headers['ETag'] = etag
+            if headers.get('If-None-Match') == etag:
+                return 304, response_headers, None
+            return 200, response_headers, response
+        if path == '/releases' and method == 'POST':
+            attributes = json.loads(body.decode())
+            # Like on GitHub, only published releases need unique tag names, several drafts can share one
+            if any(r['tag_name'] == attributes['tag_name'] and not r['draft'] for r in self.releases.values()):
+                return self._error(422, 'Validation Failed: tag_name already_exists')
+            release = self._create_release(attributes['tag_name'], attributes.get('target_commitish', 'master'), attributes.get('draft', False),
+                                           attributes.get('name', ''), attributes.get('body', ''), attributes.get('prerelease', False))
+            return 201, {}, self._release_json(base_url, release)
+        match = re.fullmatch('/releases/([0-9]+)(/assets)?', path)
+        if match:
+            release = self.releases.get(int(match.group(1)))
+            if not release:
+                return self._error(404, 'Not Found')
+            if match.group(2) and method == 'GET':
+                response_headers, page = self._page(base_url, repo + path, query, release['assets'])
+                return 200, response_headers, [self._asset_json(base_url, self.assets[asset_id]) for asset_id in page]
+            if match.group(2) and method == 'POST':
+                if any(self.assets[asset_id]['name'] == query['name'] for asset_id in release['assets']):
+                    return self._error(422, 'Validation Failed: name already_exists')
+                return 201, {}, self._asset_json(base_url, self._create_asset(release, query['name'], body))
+            if method == 'PATCH':
+                attributes = json.loads(body.decode())
+                if any(r['tag_name'] == attributes.get('tag_name', release['tag_name']) and not r['draft'] and r['id'] != release['id']
+                       for r in self.releases.values()):
+                    return self._error(422, 'Validation Failed: tag_name already_exists')
+                for key in ['tag_name', 'name', 'body', 'draft', 'prerelease']:
+                    if key in attributes:
+                        release[key] = attributes[key]
+                if not release['draft']:
+                    release['published_at'] = release['published_at'] or datetime.datetime.utcnow().replace(microsecond=0).isoformat() + 'Z'
+                    self.tags.add(release['tag_name'])
+                return 200, {}, self._release_json(base_url, release)
+            if method == 'DELETE':
+                for asset_id in release['assets']:
+                    del self.assets[asset_id]
+                del self.releases[release['id']]
+                return 204, {}, None
+        match = re.fullmatch('/releases/assets/([0-9]+)', path)
+        if match:
+            asset = self.assets.get(int(match.group(1)))
+            if not asset:
+                return self._error(404, 'Not Found')
+            if method == 'GET' and headers.get('Accept') == 'application/octet-stream':
+                asset['download_count'] += 1
+                match = re.fullmatch('bytes=([0-9]+)-', headers.get('Range', ''))
+                if match and int(match.group(1)) < asset['size']:
+                    return 206, {'Content-Type': 'application/octet-stream'}, asset['data'][int(match.group(1)):]
+                return 200, {'Content-Type': 'application/octet-stream'}, asset['data']
+            if method == 'GET':
+                return 200, {}, self._asset_json(base_url, asset)
+            if method == 'DELETE':
+                self.releases[asset['release_id']]['assets'].remove(asset['id'])
+                del self.assets[asset['id']]
+                return 204, {}, None
+        if path.startswith('/git/matching-refs/tags/') and method == 'GET':
+            prefix = urllib.parse.unquote(path[len('/git/matching-refs/tags/'):])
+            refs = [{'ref': 'refs/tags/{}'.format(tag_name), 'object': {'type': 'commit', 'sha': '0' * 40}}
+                    for tag_name in sorted(self.tags) if tag_name.startswith(prefix)]
+            response_headers, page = self._page(base_url, repo + path, query, refs)
+            return 200, response_headers, page
+        if path.startswith('/git/matching-refs/') and method == 'GET':
+            prefix = 'refs/' + urllib.parse.unquote(path[len('/git/matching-refs/'):])
+            refs = [{'ref': ref, 'object': {'type': 'commit', 'sha': sha}} for ref, sha in sorted(self.refs.items()) if ref.startswith(prefix)]
+            response_headers, page = self._page(base_url, repo + path, query, refs)
+            return 200, response_headers, page
+        if path == '/branches' and method == 'GET':
+            response_headers, page = self._page(base_url, repo + path, query, [{'name': branch, 'protected': False} for branch in self.branches])
+            return 200, response_headers, page
+        if path == '/git/commits' and method == 'POST':
+            attributes = json.loads(body.decode())
+            if any(parent not in self.commits for parent in attributes['parents']):
+                return self._error(422, 'Parent SHA does not exist')
+            sha = hashlib.sha1(json.dumps([attributes, self._next_id]).encode()).hexdigest()
+            self._next_id += 1
+            self.commits[sha] = {'sha': sha, 'message': attributes['message'], 'tree': {'sha': attributes['tree']},
+                                 'parents': [{'sha': parent} for parent in attributes['parents']]}
+            return 201, {}, self.commits[sha]
+        if path.startswith('/git/commits/') and method == 'GET':
+            commit = self.commits.get(path[len('/git/commits/'):])
+            if not commit:
+                return self._error(404, 'Not Found')
+            if headers.get('If-None-Match') == '"{}"'.format(commit['sha']):
+                return 304, {'ETag': '"{}"'.format(commit['sha'])}, None
+            return 200, {'ETag': '"{}"'.format(commit['sha'])}, commit
+        if path.startswith('/git/ref/') and method == 'GET':
+            ref = 'refs/' + urllib.parse.unquote(path[len('/git/ref/'):])
+            if ref not in self.refs:
+                return self._error(404, 'Not Found')
+            return 200, {}, {'ref': ref, 'object': {'type': 'commit', 'sha': self.refs[ref]}}
+        if path == '/git/refs' and method == 'POST':
+            attributes = json.loads(body.decode())
+            if attributes['ref'] in self.refs:
+                return self._error(422, 'Reference already exists')
+            self.refs[attributes['ref']] = attributes['sha']
+            return 201, {}, {'ref': attributes['ref'], 'object': {'type': 'commit', 'sha': attributes['sha']}}
+        if path.startswith('/git/refs/tags/') and method == 'DELETE':
+            tag_name = urllib.parse.unquote(path[len('/git/refs/tags/'):])
+            if tag_name not in self.tags:
+                # GitHub says 422 rather than 404 on deleting a reference that doesn't exist
+                return self._error(422, 'Reference does not exist')
+            self.tags.remove(tag_name)
+            return 204, {}, None
+        if path.startswith('/git/refs/') and method == 'DELETE':
+            ref = 'refs/' + urllib.parse.unquote(path[len('/git/refs/'):])
+            if ref not in self.refs:
+                return self._error(422, 'Reference does not exist')
+            del self.refs[ref]
+            return 204, {}, None
+        return self._error(404, 'Not Found')
+
+# Routes requests to Travis-CI Enterprise API, which lives under /api, to a fake Travis-CI and the rest to a fake GitHub.
+class FakeServices:
+    def __init__(self, github, travis):
+        self.github = github
+        self.travis = travis
+
+    def handle(self, method, path, query, headers, body):
+        if path.startswith('/api/'):
+            return self.travis.handle(method, path[len('/api'):], query, headers, body)
+        return self.github.handle(method, path, query, headers, body)
+
+# http.server.ThreadingHTTPServer exists only since Python 3.7
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+# Serves a fake API over HTTP on localhost, counting the requests made and the bytes sent and received. Each response
+# is delayed by `latency` seconds and request and response bodies are throttled to `bandwidth` bytes per second per
+# connection, unless it's 0.
+class FakeServer:
+    def __init__(self, api, latency=0.0, bandwidth=0):
+        self.api = api
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.requests = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def _read_body(self):
+                if self.headers.get('Transfer-Encoding') != 'chunked':
+                    length = int(self.headers.get('Content-Length', 0))
+                    return self.rfile.read(length) if length else b''
+                chunks = []
+                while True:
+                    length = int(self.rfile.readline().split(b';')[0], 16)
+                    chunks.append(self.rfile.read(length))
+                    self.rfile.readline()
+                    if not length:
+                        return b''.join(chunks)
+
+            def _throttle(self, size):
+                if server.bandwidth:
+                    time.sleep(size / server.bandwidth)
+
+            def _handle(self):
+                url = urllib.parse.urlsplit(self.path)
+                query = dict(urllib.parse.parse_qsl(url.query))
+                body = self._read_body()
+                self._throttle(len(body))
+                time.sleep(server.latency)
+                status, headers, response = server.api.handle(self.command, url.path, query, self.headers, body)
+                if response is None:
+                    data = b''
+                elif isinstance(response, bytes):
+                    data = response
+                else:
+                    data = json.dumps(response).encode()
+                self._throttle(len(data))
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+                with server._lock:
+                    server.requests += 1
+                    server.bytes_sent += len(data)
+                    server.bytes_received += len(body)
+
+            do_GET = do_POST = do_PATCH = do_PUT = do_DELETE = _handle
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self._server.server_port)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def reset_counters(self):
+        with self._lock:
+            self.requests = 0
+            self.bytes_sent = 0
+            self.bytes_received = 0
+
+    def shutdown(self):
+        self._server.shutdown()
+
+# Compares finding unfinished builds of a branch using the server-side filters against scanning all builds of
+# the repository and filtering them on the client, like it used to be done.
+def benchmark_travis_scan(args):
+    fake = FakeTravis('owner/repo', args.builds, args.branches, args.unfinished)
+    server = FakeServer(fake, args.latency)
+    travis = ci_release_publisher.Travis('fake-travis-token', server.url)
+
+    def client_side_scan():
+        build_numbers = []
+        for build in travis.builds(fake.repo_slug, {'sort_by': 'finished_at:desc'}, jobs=1):
+            if build['branch']['name'] != args.branch or build['repository']['slug'] != fake.repo_slug:
+                continue
+            if build['finished_at'] != None:
+                break
+            build_numbers.append(int(build['number']))
+        return build_numbers
+
+    def server_side_scan():
+        return travis.branch_unfinished_build_numbers(fake.repo_slug, args.branch)
+
+    results = []
+    for name, scan in [('client-side filtering', client_side_scan), ('server-side filtering', server_side_scan)]:
+        server.reset_counters()
+        start_time = time.time()
+        build_numbers = scan()
+        results.append((name, sorted(build_numbers), server.requests, server.bytes_sent, time.time() - start_time))
+    server.shutdown()
+    print('{} builds across {} branches, {} of them unfinished.'.format(args.builds, args.branches, args.unfinished))
+    for name, build_numbers, requests, bytes_sent, elapsed_time in results:
+        print('{:>22}: found {} unfinished builds of "{}" branch with {} pages ({:.1f} KiB) in {:.2f} seconds.'.format(
+            name, len(build_numbers), args.branch, requests, bytes_sent/1024, elapsed_time))
+    if results[0][1] != results[1][1]:
+        print('Warning: the scans found different builds: {} and {}.'.format(results[0][1], results[1][1]))
+
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ci_release_publisher.py')
+
+# Runs ci_release_publisher.py, writing its peak RSS in bytes into a file on exit. The peak RSS reported by the OS
+# for a child process can't be used, as it includes the RSS of this process at the time it was forked.
+RSS_WRAPPER = '''
+import atexit, resource, runpy, sys
+
+def write_peak_rss():
+    try:
+        # VmHWM is reset by exec, unlike ru_maxrss
+        with open('/proc/self/status') as f:
+            peak_rss = [int(line.split()[1]) * 1024 for line in f if line.startswith('VmHWM:')][0]
+    except (OSError, IndexError):
+        # ru_maxrss is in KiB on Linux but in bytes on macOS
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    with open(rss_path, 'w') as f:
+        f.write(str(peak_rss))
+
+rss_path = sys.argv.pop(2)
+atexit.register(write_peak_rss)
+sys.argv = sys.argv[1:]
+runpy.run_path(sys.argv[0], run_name='__main__')
+'''
+
+# Runs ci_release_publisher.py processes at the same time and waits for all of them to finish. Returns the wall time
+# along with the exit code and the peak RSS in bytes of each of the processes.
+def run_processes(commands, on_exit=None):
+    start_time = time.time()
+    processes = []
+    for command, env, log_path in commands:
+        with open(log_path, 'wb') as log:
+            processes.append(subprocess.Popen([sys.executable, '-c', RSS_WRAPPER, SCRIPT_PATH, log_path + '.rss'] + command,
+                                              env=env, stdout=log, stderr=subprocess.STDOUT))
+    # Processes are polled rather than waited for in order, so that `on_exit` is called with the index and exit code of
+    # each process right as it exits, e.g. to mark its Travis-CI job finished
+    running = list(range(len(processes)))
+    while running:
+        for i in [i for i in running if processes[i].poll() is not None]:
+            running.remove(i)
+            if on_exit:
+                on_exit(i, processes[i].returncode)
+        time.sleep(0.01)
+    results = []
+    for process, (_, _, log_path) in zip(processes, commands):
+        peak_rss = 0
+        if os.path.isfile(log_path + '.rss'):
+            with open(log_path + '.rss') as f:
+                peak_rss = int(f.read())
+        results.append((process.returncode, peak_rss))
+    return time.time() - start_time, results
+
+# Writes `count` files of random, incompressible data for a job
+def make_artifacts(artifact_dir, job, count, size):
+    os.makedirs(artifact_dir)
+    for i in range(count):
+        with open(os.path.join(artifact_dir, 'job-{}-artifact-{}.bin'.format(job, i)), 'wb') as f:
+            for offset in range(0, size, 1024*1024):
+                f.write(os.urandom(min(1024*1024, size - offset)))
+
+# Returns a list of problems with the state of the fake GitHub after a phase, which would point to a bug or a race.
+def check_phase(phase, github, args, build, artifact_dirs, collect_dir):
+    problems = []
+    releases = {r['tag_name']: r for r in github.releases.values()}
+
+    def artifact_count(tag_name):
+        return sum(1 for asset_id in releases[tag_name]['assets'] if github.assets[asset_id]['name'] != ci_release_publisher.MANIFEST_NAME)
+
+    stored = ['ci-{}-{}-{}'.format(args.branch, build['number'], job) for job in range(1, args.jobs + 1)]
+    if phase == 'store':
+        for tag_name in stored:
+            if tag_name not in releases:
+                problems.append('"{}" release is missing'.format(tag_name))
+            elif artifact_count(tag_name) != args.artifacts:
+                problems.append('"{}" release has {} artifacts instead of {}'.format(tag_name, artifact_count(tag_name), args.artifacts))
+    elif phase == 'collect':
+        for artifact_dir in artifact_dirs:
+            for artifact in os.listdir(artifact_dir):
+                collected_path = os.path.join(collect_dir, artifact)
+                if not os.path.isfile(collected_path):
+                    problems.append('"{}" artifact is missing'.format(artifact))
+                elif ci_release_publisher.sha256_file(collected_path) != ci_release_publisher.sha256_file(os.path.join(artifact_dir, artifact)):
+                    problems.append('"{}" artifact is corrupted'.format(artifact))
+    elif phase == 'cleanup':
+        problems.extend('"{}" release was not deleted'.format(tag_name) for tag_name in stored if tag_name in releases)
+    elif phase == 'publish':
+        for tag_name in ['ci-{}-latest'.format(args.branch), 'ci-{}-{}'.format(args.branch, build['number'])]:
+            if tag_name not in releases or releases[tag_name]['draft']:
+                problems.append('"{}" release is missing'.format(tag_name))
+            elif artifact_count(tag_name) != args.jobs * args.artifacts:
+                problems.append('"{}" release has {} artifacts instead of {}'.format(tag_name, artifact_count(tag_name), args.jobs * args.artifacts))
+        problems.extend('temporary "{}" release was left behind'.format(tag_name) for tag_name in releases if tag_name.startswith('_ci-'))
+        lease_refs = [ref for ref in github.refs if ref.startswith(ci_release_publisher.LEASE_REF_PREFIX)]
+        if len(lease_refs) > 2:
+            problems.append('{} lease references were left behind instead of at most 2'.format(len(lease_refs)))
+    elif phase == 'gc':
+        for branch in github.branches:
+            numbered = [tag_name for tag_name in releases if re.fullmatch('ci-{}-[0-9]+'.format(re.escape(branch)), tag_name)]
+            if len(numbered) > 3:
+                problems.append('"{}" branch has {} numbered releases left'.format(branch, len(numbered)))
+        problems.extend('"{}" release is left of a finished build'.format(tag_name) for tag_name, release in releases.items()
+                        if release['draft'] and re.fullmatch('ci-.+-[0-9]+-[0-9]+', tag_name))
+        problems.extend('"{}" tag has no release'.format(tag_name) for tag_name in github.tags if tag_name not in releases)
+    return problems
+
+# Parses PHASE=N argument of --max-requests into a (phase, max_requests) tuple
+def phase_max_requests(value):
+    phase, _, count = value.partition('=')
+    if not phase or not count.isdigit():
+        raise argparse.ArgumentTypeError('"{}" is not in PHASE=N format.'.format(value))
+    return phase, int(count)
+
+# Runs store, collect, cleanup, publish and gc commands of ci_release_publisher.py end to end against a fake GitHub and
+# Travis-CI seeded with releases and builds, as separate processes just like on Travis-CI. `store` and `cleanup` are
+# run by --jobs processes at the same time, racing like jobs of a build matrix would. With --collect-wait, `collect --wait`
+# runs as one more job alongside the `store` jobs, which are marked finished on the fake Travis-CI as their processes exit.
+# With --deploy, a single `deploy` replaces collect, cleanup and publish. A phase making more requests than its
+# --max-requests fails the benchmark, so that regressions can be caught on CI.
+def benchmark_commands(args):
+    repo_slug = 'owner/repo'
+    travis = FakeTravis(repo_slug, args.builds, args.branches, args.unfinished)
+    build = travis.add_build(args.branch, args.jobs + 1 if args.collect_wait else args.jobs)
+    github = FakeGitHub(repo_slug, travis, args.releases, args.assets_per_release, args.asset_size, args.rate_limit, args.rate_limit_window,
+                        args.deleted_branches)
+    server = FakeServer(FakeServices(github, travis), args.latency, args.bandwidth * 1024 * 1024)
+    print('{} releases with {} assets of {} bytes each, {} builds across {} branches.'.format(
+        len(github.releases), args.assets_per_release, args.asset_size, len(travis.builds), args.branches))
+    print('{} jobs storing {} artifacts of {} bytes each.'.format(args.jobs, args.artifacts, args.artifact_size))
+    max_requests = dict(max_request for max_request in args.max_requests)
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        artifact_dirs = [os.path.join(tmp_dir, 'artifacts-{}'.format(job)) for job in range(1, args.jobs + 1)]
+        for job, artifact_dir in enumerate(artifact_dirs, 1):
+            make_artifacts(artifact_dir, job, args.artifacts, args.artifact_size)
+        collect_dir = os.path.join(tmp_dir, 'collected')
+        os.makedirs(collect_dir)
+        log_dir = os.path.join(tmp_dir, 'logs')
+        os.makedirs(log_dir)
+
+        def command(phase, job, *command_args):
+            env = dict(os.environ)
+            env.pop('TRAVIS_TAG', None)
+            env.update({
+                'GITHUB_ACCESS_TOKEN': 'fake-github-token',
+                'TRAVIS_REPO_SLUG': repo_slug,
+                'TRAVIS_BRANCH': args.branch,
+                'TRAVIS_COMMIT': build['commit']['sha'],
+                'TRAVIS_BUILD_NUMBER': build['number'],
+                'TRAVIS_BUILD_ID': str(build['id']),
+                'TRAVIS_JOB_NUMBER': '{}.{}'.format(build['number'], job),
+                'TRAVIS_JOB_ID': str(build['id'] * 100 + job),
+            })
+            command = ['--travis-enterprise', server.url, '--github-api-url', server.url]
+            command += shlex.split(args.script_args) + [phase] + list(command_args)
+            return command, env, os.path.join(log_dir, '{}-{}.log'.format(phase, job))
+
+        def store_finished(i, exit_code):
+            if i < args.jobs:
+                travis.set_job_state(build, i + 1, 'passed' if exit_code == 0 else 'failed')
+
+        store_commands = [command('store', job, artifact_dir) for job, artifact_dir in enumerate(artifact_dirs, 1)]
+        release_args = ['--latest-release', '--numbered-release', '--numbered-release-keep-count', '3', '--release-index-json', os.path.join(tmp_dir, 'releases.json')]
+        if args.collect_wait:
+            phases = [('store+collect', store_commands + [command('collect', args.jobs + 1, collect_dir, '--wait', '--poll-interval', '0.2')], store_finished)]
+        else:
+            phases = [('store', store_commands, None)]
+            if not args.deploy:
+                phases += [('collect', [command('collect', 1, collect_dir)], None)]
+        if args.deploy:
+            # deploy does what cleanup and publish do, streaming the stored artifacts instead of collecting them to the disk
+            phases += [('deploy', [command('deploy', 1, *release_args)], None)]
+        else:
+            phases += [
+                ('cleanup', [command('cleanup', job) for job in range(1, args.jobs + 1)], None),
+                ('publish', [command('publish', 1, collect_dir, *release_args)], None),
+            ]
+        phases += [('gc', [command('gc', 1, '--keep-count', '3', '--delete-stale-branches')], None)]
+        for phase, commands, on_exit in phases:
+            server.reset_counters()
+            elapsed_time, results = run_processes(commands, on_exit)
+            failures = [(c, r) for c, r in zip(commands, results) if r[0] != 0]
+            print('{:>8}: {} processes in {:.2f} seconds, {} requests, {:.1f} MiB up, {:.1f} MiB down, peak RSS {:.1f} MiB{}.'.format(
+                phase, len(commands), elapsed_time, server.requests, server.bytes_received/1024/1024, server.bytes_sent/1024/1024,
+                max(rss for _, rss in results)/1024/1024, ', {} failed'.format(len(failures)) if failures else ''))
+            for (_, _, log_path), (exit_code, _) in failures:
+                print('\t{} exited with {}:'.format(os.path.basename(log_path), exit_code))
+                with open(log_path) as f:
+                    print('\t\t' + f.read().strip().replace('\n', '\n\t\t'))
+            checks = ['cleanup', 'publish'] if phase == 'deploy' else phase.split('+')
+            problems = [problem for p in checks for problem in check_phase(p, github, args, build, artifact_dirs, collect_dir)]
+            if phase in max_requests and server.requests > max_requests[phase]:
+                problems.append('{} requests made, more than the maximum of {}'.format(server.requests, max_requests[phase]))
+            for problem in problems:
+                print('\tProblem: {}.'.format(problem))
+            failed = failed or bool(failures) or bool(problems)
+    server.shutdown()
+    return failed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks of ci_release_publisher.py against local fake GitHub and Travis-CI API servers.')
+    parser.add_argument('--latency', type=float, default=0.05, help='Latency of each fake API response, in seconds.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    parser_travis_scan = subparsers.add_parser('travis-scan', help='Find unfinished builds of a branch on Travis-CI.')
+    parser_travis_scan.add_argument('--builds', type=int, default=5000, help='Number of builds in the repository.')
+    parser_travis_scan.add_argument('--branches', type=int, default=20, help='Number of branches the builds are spread across.')
+    parser_travis_scan.add_argument('--unfinished', type=int, default=10, help='Number of the most recent builds that have not finished yet.')
+    parser_travis_scan.add_argument('--branch', type=str, default='master', help='Branch to look for unfinished builds of.')
+
+    parser_commands = subparsers.add_parser('commands', help='Run store, collect, cleanup, publish and gc commands end to end.')
+    parser_commands.add_argument('--releases', type=int, default=300, help='Number of releases the repository is seeded with.')
+    parser_commands.add_argument('--assets-per-release', type=int, default=5, help='Number of assets in each seeded release.')
+    parser_commands.add_argument('--asset-size', type=int, default=1024, help='Size of each seeded asset, in bytes.')
+    parser_commands.add_argument('--builds', type=int, default=500, help='Number of builds in the repository.')
+    parser_commands.add_argument('--branches', type=int, default=5, help='Number of branches the builds are spread across.')
+    parser_commands.add_argument('--unfinished', type=int, default=3, help='Number of the most recent builds that have not finished yet.')
+    parser_commands.add_argument('--branch', type=str, default='master', help='Branch of the build running the commands.')
+    parser_commands.add_argument('--deleted-branches', type=int, default=1, help='Number of branches with builds that no longer exist in the repository.')
+    parser_commands.add_argument('--jobs', type=int, default=1, help='Number of build jobs running store and cleanup at the same time.')
+    parser_commands.add_argument('--collect-wait', dest='collect_wait', action='store_true',
+                                 help='Run "collect --wait" at the same time as the store jobs instead of after them.')
+    parser_commands.set_defaults(collect_wait=False)
+    parser_commands.add_argument('--deploy', dest='deploy', action='store_true',
+                                 help='Run a single "deploy" instead of collect, cleanup and publish.')
+    parser_commands.set_defaults(deploy=False)
+    parser_commands.add_argument('--artifacts', type=int, default=5, help='Number of artifacts each job stores.')
+    parser_commands.add_argument('--artifact-size', type=int, default=1024*1024, help='Size of each artifact, in bytes.')
+    parser_commands.add_argument('--bandwidth', type=float, default=0, help='Bandwidth of each connection, in MiB/s. 0 means unlimited.')
+    parser_commands.add_argument('--rate-limit', type=int, default=0, help='Number of GitHub API requests allowed per rate limit window. 0 means unlimited.')
+    parser_commands.add_argument('--rate-limit-window', type=int, default=3600, help='Length of the rate limit window, in seconds.')
+    parser_commands.add_argument('--script-args', type=str, default='',
+                                 help='Additional arguments to pass to ci_release_publisher.py, e.g. "--upload-jobs 4 --request-rate 100".')
+
+    parser_commands.add_argument('--max-requests', type=phase_max_requests, action='append', default=[],
+                                 help='Fail if a phase makes more requests than this, given as PHASE=N, e.g. "publish=130". Can be repeated.')
+
+    args = parser.parse_args()
+    if args.command == 'travis-scan':
+        benchmark_travis_scan(args)
+    elif args.command == 'commands':
+        sys.exit(1 if benchmark_commands(args) else 0)
+    else:
+        parser.print_help()
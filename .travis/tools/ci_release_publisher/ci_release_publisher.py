@@ -1,14 +1,41 @@
 import argparse
-import cgi
+import bisect
+import concurrent.futures
+import contextlib
 import datetime
+import email.utils
+import functools
 import github
+import hashlib
+import json
+import multiprocessing
 import os
+import queue
+import random
 import re
 import requests
 import shutil
 import sys
+import tarfile
+import tempfile
+import threading
 import time
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 # Apparently there is no Traivis API python library that supports the latest API version (v3)
 # There is travispy, it supports v2 (v2 is being phased out this (2018) year) and it doesn't
 # allow to get the info we need, so we roll out our own awefully specific Travis API class.
@@ -18,12 +45,15 @@ class Travis:
         'User-Agent': 'ci-release-publisher',
     }
 
-    def __init__(self, travis_token, travis_api_url):
+    def __init__(self, travis_token, travis_api_url, cache=None):
         self._api_url = travis_api_url
+        self._headers = dict(Travis._headers)
         self._headers['Authorization'] = 'token {}'.format(travis_token)
+        self._cache = cache if cache else MetadataCache()
 
     @classmethod
-    def github_auth(cls, github_token, travis_api_url):
+    def github_auth(cls, github_token, travis_api_url, cache=None):
+        cache = cache if cache else MetadataCache()
         # We have to use API 2.1 to get Travis-CI token based on GitHub token.
         # See https://github.com/travis-ci/travis-ci/issues/9273.
         # API 2.1 is supposedly getting deprecaed sometime in 2018, so hopefully they will add
@@ -34,128 +64,1293 @@ class Travis:
             'User-Agent': cls._headers['User-Agent'],
         }
         # API doc: https://docs.travis-ci.com/api/?http#with-a-github-token
-        response = requests.post('{}/auth/github'.format(travis_api_url), headers=headers, params={'github_token': github_token})
-        return Travis(response.json()['access_token'], travis_api_url)
+        response = cache.session.post('{}/auth/github'.format(travis_api_url), headers=headers, params={'github_token': github_token})
+        return Travis(response.json()['access_token'], travis_api_url, cache)
 
     # Returns last build number for a branch
     def branch_last_build_number(self, repo_slug, branch_name):
         _repo_slug = requests.utils.quote(repo_slug, safe='')
         _branch_name = requests.utils.quote(branch_name, safe='')
         # API doc: https://developer.travis-ci.com/resource/branch
-        response = requests.get('{}/repo/{}/branch/{}'.format(self._api_url, _repo_slug, _branch_name), headers=self._headers)
-        return response.json()['last_build']['number']
+        json, _ = self._cache.get('{}/repo/{}/branch/{}'.format(self._api_url, _repo_slug, _branch_name), headers=self._headers)
+        return json['last_build']['number']
+
+    # Yields builds of a repository matching the query parameters, in the order the API returns them.
+    # After the first page tells us how many builds there are, the following pages are fetched `jobs` pages at a time
+    # concurrently. Pages are only fetched as the builds are consumed, so stopping the iteration stops the fetching.
+    def builds(self, repo_slug, params, jobs=4):
+        _repo_slug = requests.utils.quote(repo_slug, safe='')
+        limit = 100 # Doesn't seem like the API allows to set this any higher, it caps at 100
+
+        def page(offset):
+            page_params = dict(params)
+            page_params['offset'] = offset
+            page_params['limit'] = limit
+            # API doc: https://developer.travis-ci.com/resource/builds
+            json, _ = self._cache.get('{}/repo/{}/builds'.format(self._api_url, _repo_slug), headers=self._headers, params=page_params)
+            return json
+
+        json = page(0)
+        yield from json['builds']
+        # `count` is how many there are builds in total
+        count = json['@pagination']['count']
+        limit = json['@pagination']['limit']
+        offsets = list(range(limit, count, limit))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            for i in range(0, len(offsets), jobs):
+                for json in executor.map(page, offsets[i:i + jobs]):
+                    yield from json['builds']
 
     # Returns a list of build numbers of all builds that have not finished for a branch.
     # "not finished" bascially means that a build is active (queued/running) and it's not a restarted
     # build as restarted builds have the finished flag set in the past by their first run.
     def branch_unfinished_build_numbers(self, repo_slug, branch_name):
-        _repo_slug = requests.utils.quote(repo_slug, safe='')
-        _branch_name = requests.utils.quote(branch_name, safe='')
-        # There is no good way to request all builds for a branch, you can request only last 10 with
-        # https://developer.travis-ci.com/resource/branch end point, which is not good enough, so we
-        # just request all builds in general, sort them by unfinished first and filter by branch ourselves.
+        params = {
+            'branch.name': branch_name,
+            # Unfinished builds are in one of these states. Restarted builds are in them too, but they have `finished_at` set.
+            'build.state': 'created,received,started',
+            # Pull request builds don't store artifacts, so we don't care about them. This also excludes builds of PRs from forks
+            # that happen to have the same branch name as ours.
+            'build.event_type': 'push,api,cron',
+            # This will put all builds that have not finished yet first, their 'finished_at' is null
+            'sort_by': 'finished_at:desc',
+        }
         build_numbers = []
-        limit = 100 # Doesn't seem like the API allows to set this any higher, it caps at 100
-        offset = 0
-        count = offset + 1  # Just something to make the while condition true for the first run, as there is no do..while in python
-        # `count` is how many there are builds in total and `offset` is how far are we in.
-        while offset < count:
-            params = {
-                # This will put all builds that have not finished yet first, their 'finished_at' is null
-                'sort_by': 'finished_at:desc',
-                'offset': offset,
-                'limit': limit,
-            }
-            # API doc: https://developer.travis-ci.com/resource/builds
-            response = requests.get('{}/repo/{}/builds'.format(self._api_url, _repo_slug, _branch_name), headers=self._headers, params=params)
-            json = response.json()
-            offset += json['@pagination']['limit']
-            count = json['@pagination']['count']
-            # We filter by repository slug too because there might be builds of PR from forks with the same branch name as ours, we don't want to include those
-            # (forks would have different repository slug).
-            branch_builds = [build for build in json['builds'] if build['branch']['name'] == branch_name and build['repository']['slug'] == repo_slug]
-            build_numbers.extend([build['number'] for build in branch_builds if build['finished_at'] == None])
+        for build in self.builds(repo_slug, params):
+            # The filters above should take care of it, but just in case we filter by branch and repository slug too,
+            # as we don't want to include builds of PR from forks (forks would have different repository slug).
+            if build['branch']['name'] != branch_name or build['repository']['slug'] != repo_slug:
+                continue
             # If we find a finished build, then there is no point in looking any further as we sort
             # them by `finished_at` field -- there would be no unfinished builds any further.
-            if any(build['finished_at'] != None for build in branch_builds):
+            if build['finished_at'] != None:
                 break
+            build_numbers.append(int(build['number']))
+        return build_numbers
+
+    # Returns a list of jobs of a build, each with its number ("<build_number>.<job_number>"), state and stage
+    def build_jobs(self, build_id):
+        params = {
+            # Stage is not included in the standard representation of a job
+            'include': 'job.stage',
+        }
+        # API doc: https://developer.travis-ci.com/resource/jobs
+        json, _ = self._cache.get('{}/build/{}/jobs'.format(self._api_url, build_id), headers=self._headers, params=params)
+        return json['jobs']
+
+    # Returns a dict of branch name to a set of build numbers of all builds of the repository that have not finished yet.
+    # Unlike branch_unfinished_build_numbers(), it includes pull request builds too, as it's used for finding out what's
+    # not safe to delete. Usually there are only a few unfinished builds, so it's just a single request.
+    def unfinished_build_numbers(self, repo_slug):
+        params = {
+            'build.state': 'created,received,started',
+        }
+        build_numbers = {}
+        for build in self.builds(repo_slug, params):
+            if build['repository']['slug'] != repo_slug:
+                continue
+            build_numbers.setdefault(build['branch']['name'], set()).add(int(build['number']))
         return build_numbers
 
 class CIReleasePublisherError(Exception):
     pass
 
-def download_artifact(github_token, src_url, dst_dir):
-    # API doc: https://developer.github.com/v3/repos/releases/#get-a-single-release-asset
-    # In order to download draft artifacts you need a GitHub token with write access to that repo,
-    # otherwise you can't download those artifacts, the download URLs are "private" in a sense.
-    headers = {
-        'Authorization': 'token {}'.format(github_token),
-        'Accept': 'application/octet-stream',
+# On-disk cache of JSON API responses keyed by the request URL. Entries are revalidated with conditional requests
+# using the ETag and Last-Modified validators of the cached response, so a cached entry is only served when the server
+# confirms it's unchanged with a 304 Not Modified response, which GitHub doesn't count against the rate limit. Entries
+# that were not revalidated for `ttl` seconds are evicted. With no `cache_dir` given every request goes to the server.
+class MetadataCache:
+    # Response headers we keep in the cache, e.g. Link is needed for following the pagination of cached pages
+    _kept_headers = ['Link']
+
+    def __init__(self, session=None, cache_dir=None, ttl=24*60*60):
+        self.session = session if session else requests.Session()
+        self._cache_dir = cache_dir
+        self._ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        if self._cache_dir:
+            os.makedirs(self._cache_dir, exist_ok=True)
+            self._evict_expired()
+
+    def _evict_expired(self):
+        for filename in os.listdir(self._cache_dir):
+            path = os.path.join(self._cache_dir, filename)
+            if filename.endswith('.json') and time.time() - os.path.getmtime(path) > self._ttl:
+                os.remove(path)
+
+    def _entry_path(self, url, headers, params):
+        # Responses depend on who is asking, e.g. draft releases are visible only to users with push access,
+        # so we key by the credentials too, hashed to not store them in plain text.
+        key = json.dumps([url, sorted((params or {}).items()), hashlib.sha256(headers.get('Authorization', '').encode()).hexdigest()])
+        return os.path.join(self._cache_dir, '{}.json'.format(hashlib.sha256(key.encode()).hexdigest()))
+
+    def _load(self, path):
+        try:
+            if time.time() - os.path.getmtime(path) > self._ttl:
+                os.remove(path)
+                return None
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _store(self, path, entry):
+        # Write to a temporary file and rename it, so that concurrently running jobs sharing the cache never see a partially written entry
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+
+    # Returns (json, headers) of a GET request, where headers contains only the _kept_headers.
+    def get(self, url, headers, params=None):
+        if not self._cache_dir:
+            response = self.session.get(url, headers=headers, params=params)
+            response.raise_for_status()
+            self.misses += 1
+            return response.json(), {h: response.headers[h] for h in self._kept_headers if h in response.headers}
+        path = self._entry_path(url, headers, params)
+        entry = self._load(path)
+        headers = dict(headers)
+        if entry:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        response = self.session.get(url, headers=headers, params=params)
+        if response.status_code == 304 and entry:
+            self.hits += 1
+            # Mark the entry as freshly revalidated
+            os.utime(path)
+            return entry['json'], entry['headers']
+        response.raise_for_status()
+        self.misses += 1
+        entry = {
+            'url': response.url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'headers': {h: response.headers[h] for h in self._kept_headers if h in response.headers},
+            'json': response.json(),
+        }
+        if entry['etag'] or entry['last_modified']:
+            self._store(path, entry)
+        return entry['json'], entry['headers']
+
+# Name of the asset containing SHA-256 hashes and sizes of all other assets of a release, which is uploaded to every release
+MANIFEST_NAME = 'SHA256SUMS.json'
+
+# Delay before the first retry of a failed request, upload or download, in seconds. Doubles with each subsequent retry.
+RETRY_BACKOFF = 5
+MAX_RETRY_BACKOFF = 120
+# The request rate never goes below this many requests per second, unless we are about to run out of the rate limit
+MIN_REQUEST_RATE = 0.5
+# Once the remaining rate limit falls below this, the remaining requests are spread until the rate limit resets
+LOW_RATE_LIMIT_REMAINING = 100
+
+# Collects timing spans, counters and gauges during a run, so that we can tell where the time goes. The report is
+# written with --metrics-json, and the spans can be written in Chrome's trace event format with --trace-json, which
+# can be viewed in chrome://tracing or https://ui.perfetto.dev.
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._start_time = time.time()
+        # (name, category, start time, duration, thread id, args)
+        self.spans = []
+        self.counters = {}
+        self.gauges = {}
+
+    @contextlib.contextmanager
+    def span(self, name, category, **args):
+        start_time = time.time()
+        try:
+            # The caller can add args to the span, e.g. the number of bytes transferred once it's known
+            yield args
+        finally:
+            self.add_span(name, category, start_time, time.time() - start_time, args)
+
+    def add_span(self, name, category, start_time, duration, args=None):
+        with self._lock:
+            self.spans.append((name, category, start_time, duration, threading.get_ident(), args if args else {}))
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    # Records the last and the lowest seen value of a gauge, e.g. of the remaining rate limit
+    def gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+            self.gauges['{}.min'.format(name)] = min(value, self.gauges.get('{}.min'.format(name), value))
+
+    # requests' response hook, accounting every HTTP request made through the shared session
+    def on_response(self, response, *args, **kwargs):
+        request = response.request
+        host = requests.utils.urlparse(request.url).hostname
+        self.count('http.requests')
+        self.count('http.requests.{}'.format(host))
+        self.count('http.responses.{}xx'.format(response.status_code // 100))
+        if request.body and hasattr(request.body, '__len__'):
+            self.count('http.bytes_sent', len(request.body))
+        if 'Content-Length' in response.headers:
+            self.count('http.bytes_received', int(response.headers['Content-Length']))
+        if 'X-RateLimit-Remaining' in response.headers:
+            self.gauge('rate_limit_remaining.{}'.format(host), int(response.headers['X-RateLimit-Remaining']))
+        # The hook is called once the response headers are received, so the span doesn't include reading a streamed body
+        self.add_span('{} {}'.format(request.method, requests.utils.urlparse(request.url).path), 'http', time.time() - response.elapsed.total_seconds(),
+                      response.elapsed.total_seconds(), {'status': response.status_code, 'host': host})
+
+    def report(self):
+        with self._lock:
+            spans = {}
+            for name, category, _, duration, _, _ in self.spans:
+                key = '{}: {}'.format(category, name) if category != 'http' else 'http'
+                summary = spans.setdefault(key, {'count': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+                summary['count'] += 1
+                summary['total_seconds'] += duration
+                summary['max_seconds'] = max(summary['max_seconds'], duration)
+            return {
+                'started_at': datetime.datetime.utcfromtimestamp(self._start_time).isoformat() + 'Z',
+                'duration_seconds': time.time() - self._start_time,
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'spans': spans,
+            }
+
+    def write_report(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+
+    # API doc: https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU
+    def write_trace(self, path):
+        with self._lock:
+            events = [{
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': int((start_time - self._start_time) * 1000000),
+                'dur': int(duration * 1000000),
+                'pid': os.getpid(),
+                'tid': thread_id,
+                'args': args,
+            } for name, category, start_time, duration, thread_id, args in self.spans]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+# Returns whether GitHub has refused a request due to a rate limit. Besides the regular rate limit, GitHub has secondary
+# rate limits that kick in on bursts of requests, especially the content-modifying ones, which are also reported with 403.
+def is_rate_limited(response):
+    if response.status_code == 429:
+        return True
+    return response.status_code == 403 and ('Retry-After' in response.headers or response.headers.get('X-RateLimit-Remaining') == '0' or
+                                            'rate limit' in response.text.lower())
+
+# Returns the number of seconds a Retry-After header asks to wait, which is either a number of seconds or an HTTP-date,
+# or None if it's neither
+def retry_after_seconds(value, now):
+    try:
+        return max(int(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - now, 0)
+    except (TypeError, ValueError, IndexError):
+        return None
+
+# Returns how long to wait before retrying for the `attempt`-th time: an exponential backoff with a full jitter, so that
+# jobs which failed at the same time don't retry at the same time too.
+def backoff_delay(attempt):
+    return random.uniform(0, min(RETRY_BACKOFF * (2 ** attempt), MAX_RETRY_BACKOFF))
+
+# Schedules all requests made through the shared session. Each host gets a token bucket of `burst` requests refilled at
+# a rate adapting to the responses: it's halved when we get rate limited and slowly grows back on success, and it's
+# lowered to spread what's left of the rate limit until its reset when the remaining rate limit runs low. When a server
+# asks us to back off, all requests to it are paused for as long as it asks.
+#
+# With `state_file` the buckets are kept in that file, locked while being updated, so that all processes on the same
+# host using the same file share the budget. That's only supported where fcntl is, otherwise the buckets are per-process.
+class RequestScheduler:
+    # Methods it's safe to retry after a server error or a connection error, as repeating them has no additional effect
+    _idempotent_methods = ['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE']
+
+    def __init__(self, rate=10.0, burst=10, retries=3, state_file=None, metrics=None):
+        self.retries = retries
+        self._max_rate = rate
+        self._burst = burst
+        self._state_file = state_file if fcntl else None
+        self._states = {}
+        self._lock = threading.Lock()
+        self._metrics = metrics if metrics else Metrics()
+
+    @contextlib.contextmanager
+    def _host_state(self, host):
+        with self._lock:
+            if not self._state_file:
+                yield self._states.setdefault(host, {'tokens': self._burst, 'updated_at': time.time(), 'rate': self._max_rate, 'paused_until': 0})
+                return
+            with open(self._state_file, 'a+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    try:
+                        states = json.loads(f.read() or '{}')
+                    except ValueError:
+                        states = {}
+                    yield states.setdefault(host, {'tokens': self._burst, 'updated_at': time.time(), 'rate': self._max_rate, 'paused_until': 0})
+                    f.seek(0)
+                    f.truncate()
+                    json.dump(states, f)
+                    f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    # Blocks until a request to the host can be made
+    def acquire(self, host):
+        while True:
+            with self._host_state(host) as state:
+                now = time.time()
+                state['tokens'] = min(self._burst, state['tokens'] + (now - state['updated_at']) * state['rate'])
+                state['updated_at'] = now
+                if state['paused_until'] > now:
+                    wait = state['paused_until'] - now
+                elif state['tokens'] >= 1:
+                    state['tokens'] -= 1
+                    return
+                else:
+                    wait = (1 - state['tokens']) / state['rate']
+            self._metrics.count('scheduler.waits')
+            self._metrics.count('scheduler.wait_seconds', wait)
+            time.sleep(wait)
+
+    # Adapts the host's bucket to the response. Returns how long to wait before retrying the request, or None if it shouldn't be retried.
+    def on_response(self, host, response, attempt):
+        remaining = response.headers.get('X-RateLimit-Remaining')
+        reset = response.headers.get('X-RateLimit-Reset')
+        with self._host_state(host) as state:
+            now = time.time()
+            if is_rate_limited(response):
+                retry_after = retry_after_seconds(response.headers.get('Retry-After', ''), now)
+                if retry_after is not None:
+                    wait = retry_after
+                elif remaining == '0' and reset:
+                    wait = int(reset) - now + 1
+                else:
+                    # GitHub doesn't always say how long to wait on hitting a secondary rate limit, its docs suggest waiting at least a minute
+                    wait = 60
+                state['paused_until'] = max(state['paused_until'], now + wait)
+                state['rate'] = max(state['rate'] / 2, MIN_REQUEST_RATE)
+                self._metrics.count('scheduler.rate_limited')
+                print('Rate limited by "{}", pausing requests to it for {:.0f} seconds.'.format(host, wait))
+                return 0
+            state['rate'] = min(state['rate'] + MIN_REQUEST_RATE, self._max_rate)
+            if remaining is not None and reset is not None and int(remaining) < LOW_RATE_LIMIT_REMAINING:
+                state['rate'] = max(min(state['rate'], int(remaining) / max(int(reset) - now, 1)), MIN_REQUEST_RATE / 10)
+        if response.status_code in (500, 502, 503, 504) and response.request.method in self._idempotent_methods:
+            return backoff_delay(attempt)
+        return None
+
+# A transport adapter making all requests go through the scheduler, retrying them as the scheduler says
+class ScheduledHTTPAdapter(requests.adapters.HTTPAdapter):
+    def __init__(self, scheduler, metrics, **kwargs):
+        super().__init__(**kwargs)
+        self._scheduler = scheduler
+        self._metrics = metrics
+
+    def send(self, request, **kwargs):
+        host = requests.utils.urlparse(request.url).hostname
+        # A streamed request body can't be sent again
+        replayable = request.body is None or isinstance(request.body, (bytes, str))
+        attempt = 0
+        while True:
+            self._scheduler.acquire(host)
+            try:
+                response = super().send(request, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt >= self._scheduler.retries or not replayable or request.method not in RequestScheduler._idempotent_methods:
+                    raise
+                delay = backoff_delay(attempt)
+                error = str(e)
+            else:
+                delay = self._scheduler.on_response(host, response, attempt)
+                if delay is None or attempt >= self._scheduler.retries or not replayable:
+                    return response
+                error = 'HTTP {} {}'.format(response.status_code, response.reason)
+                response.close()
+            attempt += 1
+            self._metrics.count('retries.request')
+            print('\t{} {} has failed: {}. Retrying in {:.0f} seconds ({}/{}).'.format(request.method, request.url, error, delay, attempt, self._scheduler.retries))
+            time.sleep(delay)
+
+# Raises an error with GitHub's explanation if the request has failed
+def github_check(response, action):
+    if response.ok:
+        return
+    try:
+        message = response.json().get('message', '')
+    except ValueError:
+        message = response.text
+    raise CIReleasePublisherError('{} has failed: HTTP {} {}: {}'.format(action, response.status_code, response.reason, message))
+
+# State shared by everything during a single run of the script, so that it's set up only once: a keep-alive HTTP
+# session with a connection pool, a GitHub client with a repository handle and a Travis-CI client which is
+# authenticated on the first use.
+class Connection:
+    def __init__(self, github_token, github_api_url, travis_api_url, travis_repo_slug, cache_dir=None, cache_ttl=24*60*60, pool_size=10,
+                 request_rate=10.0, request_retries=3, scheduler_state_file=None):
+        self.github_token = github_token
+        self.github_api_url = github_api_url
+        self.travis_api_url = travis_api_url
+        self.travis_repo_slug = travis_repo_slug
+        self.metrics = Metrics()
+        self.scheduler = RequestScheduler(request_rate, max(int(request_rate), 1), request_retries, scheduler_state_file, self.metrics)
+        self.session = requests.Session()
+        # Let all concurrent uploads and downloads keep their connections alive
+        adapter = ScheduledHTTPAdapter(self.scheduler, self.metrics, pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers['User-Agent'] = Travis._headers['User-Agent']
+        self.session.hooks['response'].append(self.metrics.on_response)
+        self.github_headers = {
+            'Authorization': 'token {}'.format(github_token),
+            'Accept': 'application/vnd.github.v3+json',
+        }
+        self.cache = MetadataCache(self.session, cache_dir, cache_ttl)
+        self.github = github.Github(login_or_token=github_token, base_url=github_api_url, per_page=100)
+        # A lazy repository object doesn't fetch the repository information, which we don't need, it just lets us make the requests
+        self.repo = self.github.get_repo(travis_repo_slug, lazy=True)
+        self._travis = None
+        self._travis_lock = threading.Lock()
+
+    # Returns a Travis-CI client, authenticating on the first call only
+    def travis(self):
+        with self._travis_lock:
+            if not self._travis:
+                self._travis = Travis.github_auth(self.github_token, self.travis_api_url, self.cache)
+            return self._travis
+
+    # Wraps release JSON into a PyGithub release object, it's bound to the lazy repository and doesn't make any requests by itself
+    def release_object(self, attributes):
+        return github.GitRelease.GitRelease(self.repo._requester, {}, attributes, completed=True)
+
+    # API doc: https://developer.github.com/v3/repos/releases/#create-a-release
+    def create_release(self, tag, name, message, draft, prerelease, target_commitish):
+        with self.metrics.span('create release', 'github', tag_name=tag):
+            response = self.session.post('{}/repos/{}/releases'.format(self.github_api_url, self.travis_repo_slug), headers=self.github_headers, json={
+                'tag_name': tag,
+                'target_commitish': target_commitish,
+                'name': name,
+                'body': message,
+                'draft': draft,
+                'prerelease': prerelease,
+            })
+        github_check(response, 'Creating "{}" release'.format(tag))
+        return self.release_object(response.json())
+
+    # Returns the updated release
+    # API doc: https://developer.github.com/v3/repos/releases/#edit-a-release
+    def update_release(self, release, name, message, draft, prerelease, tag_name=None):
+        attributes = {
+            'name': name,
+            'body': message,
+            'draft': draft,
+            'prerelease': prerelease,
+        }
+        if tag_name:
+            attributes['tag_name'] = tag_name
+        with self.metrics.span('update release', 'github', tag_name=release.tag_name):
+            response = self.session.patch('{}/repos/{}/releases/{}'.format(self.github_api_url, self.travis_repo_slug, release.id), headers=self.github_headers, json=attributes)
+        github_check(response, 'Updating "{}" release'.format(release.tag_name))
+        return self.release_object(response.json())
+
+    # API doc: https://developer.github.com/v3/repos/releases/#upload-a-release-asset
+    def upload_asset(self, release, name, size, data):
+        headers = dict(self.github_headers)
+        headers['Content-Type'] = 'application/octet-stream'
+        headers['Content-Length'] = str(size)
+        # The upload URL is a URI template with the query parameters in it
+        url = release.upload_url.split('{')[0]
+        with self.metrics.span('upload asset', 'github', tag_name=release.tag_name, asset=name, bytes=size):
+            response = self.session.post(url, headers=headers, params={'name': name}, data=data)
+        github_check(response, 'Uploading "{}" to "{}" release'.format(name, release.tag_name))
+
+    # API doc: https://developer.github.com/v3/repos/releases/#list-assets-for-a-release
+    def release_assets(self, release):
+        assets = []
+        url = '{}/repos/{}/releases/{}/assets'.format(self.github_api_url, self.travis_repo_slug, release.id)
+        params = {'per_page': 100}
+        with self.metrics.span('list release assets', 'github', tag_name=release.tag_name):
+            while url:
+                response = self.session.get(url, headers=self.github_headers, params=params)
+                github_check(response, 'Listing assets of "{}" release'.format(release.tag_name))
+                assets.extend(github.GitReleaseAsset.GitReleaseAsset(self.repo._requester, {}, attributes, completed=True) for attributes in response.json())
+                url = response.links.get('next', {}).get('url')
+                params = None
+        return assets
+
+    # Returns the SHA the reference points to, or None if there is no such reference
+    # API doc: https://docs.github.com/en/rest/git/refs#get-a-reference
+    def git_ref(self, ref):
+        with self.metrics.span('get ref', 'github', ref=ref):
+            # Unlike "git/refs/<ref>", "git/ref/<ref>" never falls back to listing the references <ref> is a prefix of
+            response = self.session.get('{}/repos/{}/git/ref/{}'.format(self.github_api_url, self.travis_repo_slug, requests.utils.quote(ref[len('refs/'):])),
+                                        headers=self.github_headers)
+        if response.status_code == 404:
+            return None
+        github_check(response, 'Getting "{}" reference'.format(ref))
+        return response.json()['object']['sha']
+
+    # Creates the reference, returning False if it already exists, which makes creating a reference an atomic
+    # test-and-set. GitHub responds with 422 to any invalid reference update, so the reference is read back to tell an
+    # existing reference from any other error.
+    # API doc: https://developer.github.com/v3/git/refs/#create-a-reference
+    def create_git_ref(self, ref, sha):
+        with self.metrics.span('create ref', 'github', ref=ref):
+            response = self.session.post('{}/repos/{}/git/refs'.format(self.github_api_url, self.travis_repo_slug), headers=self.github_headers,
+                                         json={'ref': ref, 'sha': sha})
+        if response.status_code == 422:
+            existing_sha = self.git_ref(ref)
+            if existing_sha is not None:
+                # A retried request could have created it already
+                return existing_sha == sha
+        github_check(response, 'Creating "{}" reference'.format(ref))
+        return True
+
+    # API doc: https://developer.github.com/v3/git/commits/#create-a-commit
+    def create_git_commit(self, message, tree_sha, parent_shas):
+        with self.metrics.span('create commit', 'github'):
+            response = self.session.post('{}/repos/{}/git/commits'.format(self.github_api_url, self.travis_repo_slug), headers=self.github_headers,
+                                         json={'message': message, 'tree': tree_sha, 'parents': parent_shas})
+        github_check(response, 'Creating a commit')
+        return response.json()['sha']
+
+    # Commits never change, so they are served from the metadata cache once fetched
+    # API doc: https://developer.github.com/v3/git/commits/#get-a-commit
+    def git_commit_message(self, sha):
+        json, _ = self.cache.get('{}/repos/{}/git/commits/{}'.format(self.github_api_url, self.travis_repo_slug, sha), headers=self.github_headers)
+        return json['message']
+
+# Index of all releases of a repository, built from a single listing of the releases.
+#
+# The releases this script creates use "ci-<branch>-<build_number>-<job_number>" (stored), "ci-<branch>-<build_number>"
+# (numbered) and "ci-<branch>-latest" (latest) tag names. Since branch names can contain dashes and digits, a tag name
+# like "ci-a-1-2" is ambiguous: it's either the job 2 stored release of build 1 of "a" branch or the numbered release of
+# build 2 of "a-1" branch. We index all possible interpretations of a tag name and let the caller disambiguate it by
+# asking about a specific branch, which is exactly what the tag name prefix matching on the release list used to do.
+class ReleaseIndex:
+    def __init__(self, releases):
+        # release id -> release
+        self._releases = {}
+        # tag name -> list of releases, as several draft releases can share a tag name
+        self._tag_names = {}
+        # branch -> sorted list of (build_number, release_id)
+        self._numbered = {}
+        # branch -> sorted list of (build_number, job_number, release_id)
+        self._stored = {}
+        for release in releases:
+            self.add(release)
+
+    # Returns all possible (kind, branch, build_number, job_number) interpretations of a tag name.
+    @staticmethod
+    def parse_tag_name(tag_name):
+        if not tag_name.startswith('ci-'):
+            return []
+        parts = tag_name[len('ci-'):].split('-')
+        keys = []
+        if len(parts) >= 3 and re.fullmatch('[0-9]+', parts[-2]) and re.fullmatch('[0-9]+', parts[-1]) and '-'.join(parts[:-2]):
+            keys.append(('stored', '-'.join(parts[:-2]), int(parts[-2]), int(parts[-1])))
+        if len(parts) >= 2 and re.fullmatch('[0-9]+', parts[-1]) and '-'.join(parts[:-1]):
+            keys.append(('numbered', '-'.join(parts[:-1]), int(parts[-1]), None))
+        if len(parts) >= 2 and parts[-1] == 'latest' and '-'.join(parts[:-1]):
+            keys.append(('latest', '-'.join(parts[:-1]), None, None))
+        return keys
+
+    def add(self, release):
+        self.remove(release)
+        self._releases[release.id] = release
+        self._tag_names.setdefault(release.tag_name, []).append(release)
+        for kind, branch, build_number, job_number in self.parse_tag_name(release.tag_name):
+            if kind == 'stored':
+                bisect.insort(self._stored.setdefault(branch, []), (build_number, job_number, release.id))
+            elif kind == 'numbered':
+                bisect.insort(self._numbered.setdefault(branch, []), (build_number, release.id))
+
+    def remove(self, release):
+        # The release might have been updated since it was added, so use the tag name it was added with
+        release = self._releases.pop(release.id, None)
+        if release is None:
+            return
+        self._tag_names[release.tag_name].remove(release)
+        if not self._tag_names[release.tag_name]:
+            del self._tag_names[release.tag_name]
+        for kind, branch, build_number, job_number in self.parse_tag_name(release.tag_name):
+            if kind == 'stored':
+                self._stored[branch].remove((build_number, job_number, release.id))
+            elif kind == 'numbered':
+                self._numbered[branch].remove((build_number, release.id))
+
+    def __contains__(self, tag_name):
+        return tag_name in self._tag_names
+
+    def __iter__(self):
+        return iter(list(self._releases.values()))
+
+    def __len__(self):
+        return len(self._releases)
+
+    # Returns a release with the tag name, preferring a published release over drafts sharing the tag name
+    def get(self, tag_name):
+        releases = self._tag_names.get(tag_name)
+        if not releases:
+            return None
+        return next((release for release in releases if not release.draft), releases[0])
+
+    # Returns the entries of a sorted list whose build number is in [build_number_from, build_number_to) range
+    @staticmethod
+    def _build_range(entries, build_number_from, build_number_to):
+        lo = 0 if build_number_from is None else bisect.bisect_left(entries, (int(build_number_from),))
+        hi = len(entries) if build_number_to is None else bisect.bisect_left(entries, (int(build_number_to),))
+        return entries[lo:hi]
+
+    # Returns numbered releases of a branch with build numbers in [build_number_from, build_number_to) range, sorted by build number
+    def numbered(self, branch, build_number_from=None, build_number_to=None):
+        entries = self._build_range(self._numbered.get(branch, []), build_number_from, build_number_to)
+        return [self._releases[release_id] for _, release_id in entries]
+
+    # Returns stored (draft) releases of a branch with build numbers in [build_number_from, build_number_to) range,
+    # sorted by build number and then by job number
+    def stored(self, branch, build_number_from=None, build_number_to=None):
+        entries = self._build_range(self._stored.get(branch, []), build_number_from, build_number_to)
+        return [self._releases[release_id] for _, _, release_id in entries if self._releases[release_id].draft]
+
+    def latest(self, branch):
+        return self.get('ci-{}-latest'.format(branch))
+
+# Fetches all items of a paginated GitHub API listing through the metadata cache
+def fetch_github_list(conn, url):
+    items = []
+    # Fetching 100 items per page, the maximum GitHub allows, instead of the default 30 cuts down the number of requests.
+    params = {'per_page': 100}
+    while url:
+        page, response_headers = conn.cache.get(url, headers=conn.github_headers, params=params)
+        items.extend(page)
+        # The next page URL already contains all the query parameters
+        url = None
+        params = None
+        for link in requests.utils.parse_header_links(response_headers.get('Link', '')):
+            if link.get('rel') == 'next':
+                url = link['url']
+    return items
+
+# Fetches all releases of the repository page by page through the metadata cache. Unchanged pages are served from the
+# cache, so that only the pages that have changed since the last run are actually transferred.
+def fetch_release_index(conn):
+    cache = conn.cache
+    start_time = time.time()
+    hits = cache.hits
+    misses = cache.misses
+    # API doc: https://developer.github.com/v3/repos/releases/#list-releases-for-a-repository
+    releases = ReleaseIndex(conn.release_object(attributes) for attributes in fetch_github_list(conn, '{}/repos/{}/releases'.format(conn.github_api_url, conn.travis_repo_slug)))
+    pages = cache.hits - hits + cache.misses - misses
+    conn.metrics.add_span('list releases', 'phase', start_time, time.time() - start_time, {'releases': len(releases), 'pages': pages, 'cached_pages': cache.hits - hits})
+    print('Fetched {} releases in {} pages ({} served from cache) in {:.2f} seconds.'.format(len(releases), pages, cache.hits - hits, time.time() - start_time))
+    return releases
+
+# Returns SHA-256 hex digest of a file, reading it in chunks so that it's never loaded into memory as a whole
+def sha256_file(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+# Returns a manifest of the artifacts, a dict of artifact name to its hash and size, hashing the artifacts concurrently
+def artifacts_manifest(artifact_paths, jobs=1):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        hashes = list(executor.map(sha256_file, artifact_paths))
+    return {
+        'algorithm': 'sha256',
+        'artifacts': {os.path.basename(path): {'sha256': sha256, 'size': os.path.getsize(path)} for path, sha256 in zip(artifact_paths, hashes)},
     }
-    r = requests.get(src_url, headers=headers, allow_redirects=True, stream=True)
-    # Figure out filename
-    # 1. Proper way of doing it
-    cd = r.headers.get('Content-Disposition')
-    filename = None
-    if cd:
-        _, params = cgi.parse_header(cd)
-        if 'filename' in params:
-            filename = params['filename']
-    # 2. Last resort way of doing it
-    if not filename:
-        filename = src_url.split('/')[-1]
-    filepath = os.path.join(dst_dir, filename)
-    # Instead of storing the entire file in RAM and then writing it to a file this writes down the file
-    # as it's being downloaded without storing it all in RAM.
-    with open(filepath, 'wb') as f:
-        shutil.copyfileobj(r.raw, f)
-    return filepath
-
-def download_artifcats(github_token, release, dst_dir):
-    print('Downloading artifacts from "{}" release.'.format(release.tag_name))
-    # This might look dumb but get_assets() returns a custom type that is a lazy list which doesn't support len(),
-    # so we eagerly load everything as we want to get len() and we'd load all of the assets later anyway.
-    assets = [asset for asset in release.get_assets()]
-    print('Found {} artifacts in the release.'.format(len(assets)))
+
+# Returns the manifest uploaded to a release, or None if the release has none, e.g. because it was made by an older version of this script.
+def fetch_manifest(conn, release, assets=None):
+    assets = assets if assets is not None else conn.release_assets(release)
     for asset in assets:
-        print('\tDownloading artifact "{}" ({:.1f} MiB)...'.format(asset.name, asset.size/1024/1024), end='', flush=True)
+        if asset.name == MANIFEST_NAME:
+            headers = dict(conn.github_headers)
+            headers['Accept'] = 'application/octet-stream'
+            response = conn.session.get(asset.url, headers=headers, allow_redirects=True)
+            response.raise_for_status()
+            return response.json()
+    return None
+
+# Bundles are tar archives of an artifact directory, split into numbered chunks: <BUNDLE_NAME>.<extension>.<chunk number>
+BUNDLE_NAME = 'ci-release-publisher-bundle.tar'
+BUNDLE_COMPRESSIONS = {
+    'gzip': 'gz',
+    'xz': 'xz',
+    'zstd': 'zst',
+}
+BUNDLE_CHUNK_RE = re.compile(r'^{}\.({})\.[0-9]{{4}}$'.format(re.escape(BUNDLE_NAME), '|'.join(BUNDLE_COMPRESSIONS.values())))
+
+# A write-only file object splitting the data written into it into files of at most `chunk_size` bytes each
+class ChunkedFileWriter:
+    def __init__(self, path_prefix, chunk_size):
+        self._path_prefix = path_prefix
+        self._chunk_size = chunk_size
+        self._file = None
+        self._file_size = 0
+        self.paths = []
+        self.size = 0
+
+    def write(self, data):
+        data = memoryview(data).cast('B')
+        written = len(data)
+        while data:
+            if not self._file or self._file_size >= self._chunk_size:
+                if self._file:
+                    self._file.close()
+                self.paths.append('{}.{:04d}'.format(self._path_prefix, len(self.paths)))
+                self._file = open(self.paths[-1], 'wb')
+                self._file_size = 0
+            n = min(len(data), self._chunk_size - self._file_size)
+            self._file.write(data[:n])
+            self._file_size += n
+            self.size += n
+            data = data[n:]
+        return written
+
+    def flush(self):
+        if self._file:
+            self._file.flush()
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+# A read-only file object reading files one after another as if they were a single file
+class ChunkedFileReader:
+    def __init__(self, paths):
+        self._paths = list(paths)
+        self._file = None
+
+    def read(self, size=-1):
+        chunks = []
+        while size != 0 and (self._file or self._paths):
+            if not self._file:
+                self._file = open(self._paths.pop(0), 'rb')
+            chunk = self._file.read(size)
+            if not chunk:
+                self._file.close()
+                self._file = None
+                continue
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b''.join(chunks)
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+# Packs the artifacts into a compressed tar archive split into chunks of at most `chunk_size` bytes, written into `dst_dir`.
+# The archive is streamed straight into the chunk files, so it's never kept in memory or written to disk more than once.
+# Returns paths of the chunk files.
+def bundle_artifacts(artifact_paths, dst_dir, compression, chunk_size):
+    print('Bundling {} artifacts using {} compression.'.format(len(artifact_paths), compression))
+    start_time = time.time()
+    chunks = ChunkedFileWriter(os.path.join(dst_dir, '{}.{}'.format(BUNDLE_NAME, BUNDLE_COMPRESSIONS[compression])), chunk_size)
+    if compression == 'zstd':
+        if not zstandard:
+            raise CIReleasePublisherError('zstd compression requires "zstandard" Python package to be installed.')
+        stream = zstandard.ZstdCompressor().stream_writer(chunks)
+        mode = 'w|'
+    else:
+        stream = chunks
+        mode = 'w|{}'.format(BUNDLE_COMPRESSIONS[compression])
+    with tarfile.open(fileobj=stream, mode=mode) as tar:
+        for artifact_path in artifact_paths:
+            tar.add(artifact_path, arcname=os.path.basename(artifact_path), recursive=False)
+    stream.close()
+    chunks.close()
+    size = sum(os.path.getsize(path) for path in artifact_paths)
+    print('Bundled {} artifacts ({:.1f} MiB) into {} chunks ({:.1f} MiB, {:.1f}% of the original size) in {:.2f} seconds.'.format(
+        len(artifact_paths), size/1024/1024, len(chunks.paths), chunks.size/1024/1024, chunks.size*100/max(size, 1), time.time() - start_time))
+    return chunks.paths
+
+# Unpacks a bundle made by bundle_artifacts() into `dst_dir`, streaming it straight from the chunk files.
+def unbundle_artifacts(chunk_paths, dst_dir):
+    chunk_paths = sorted(chunk_paths)
+    extension = BUNDLE_CHUNK_RE.match(os.path.basename(chunk_paths[0])).group(1)
+    print('Unbundling {} chunks of "{}".'.format(len(chunk_paths), os.path.basename(chunk_paths[0])[:-len('.0000')]))
+    start_time = time.time()
+    chunks = ChunkedFileReader(chunk_paths)
+    if extension == 'zst':
+        if not zstandard:
+            raise CIReleasePublisherError('zstd compression requires "zstandard" Python package to be installed.')
+        stream = zstandard.ZstdDecompressor().stream_reader(chunks)
+        mode = 'r|'
+    else:
+        stream = chunks
+        mode = 'r|{}'.format(extension)
+    count = 0
+    size = 0
+    with tarfile.open(fileobj=stream, mode=mode) as tar:
+        for member in tar:
+            # We only ever put regular files with no directory components in a bundle, anything else is not ours
+            if not member.isfile() or os.path.basename(member.name) != member.name or member.name in ('.', '..'):
+                raise CIReleasePublisherError('Unexpected "{}" entry in the bundle.'.format(member.name))
+            dst_path = os.path.join(dst_dir, member.name)
+            with open('{}.part'.format(dst_path), 'wb') as f:
+                shutil.copyfileobj(tar.extractfile(member), f)
+            os.replace('{}.part'.format(dst_path), dst_path)
+            count += 1
+            size += member.size
+    chunks.close()
+    compressed_size = sum(os.path.getsize(path) for path in chunk_paths)
+    print('Unbundled {} artifacts ({:.1f} MiB from {:.1f} MiB) in {:.2f} seconds.'.format(count, size/1024/1024, compressed_size/1024/1024, time.time() - start_time))
+
+# Downloads a release asset into `dst_path`, resuming a partial download left by a previous attempt if there is one.
+# Returns the number of bytes actually transferred.
+def download_artifact(conn, src_url, dst_path, size, sha256=None):
+    if os.path.isfile(dst_path) and os.path.getsize(dst_path) == size:
+        if not sha256 or sha256_file(dst_path) == sha256:
+            return 0
+        os.remove(dst_path)
+    # We download into a temporary file and rename it once it's complete, so that a file with the final name
+    # is always a complete file and a partially downloaded one can be resumed later on.
+    tmp_path = '{}.part'.format(dst_path)
+    offset = os.path.getsize(tmp_path) if os.path.isfile(tmp_path) else 0
+    if offset > size:
+        offset = 0
+    transferred = 0
+    if offset < size:
+        # API doc: https://developer.github.com/v3/repos/releases/#get-a-single-release-asset
+        # In order to download draft artifacts you need a GitHub token with write access to that repo,
+        # otherwise you can't download those artifacts, the download URLs are "private" in a sense.
+        headers = dict(conn.github_headers)
+        headers['Accept'] = 'application/octet-stream'
+        if offset:
+            headers['Range'] = 'bytes={}-'.format(offset)
+        r = conn.session.get(src_url, headers=headers, allow_redirects=True, stream=True)
+        r.raise_for_status()
+        # The server is free to ignore the Range header and send us the whole file
+        if r.status_code != 206:
+            offset = 0
+        # Instead of storing the entire file in RAM and then writing it to a file this writes down the file
+        # as it's being downloaded without storing it all in RAM.
+        with open(tmp_path, 'ab' if offset else 'wb') as f:
+            shutil.copyfileobj(r.raw, f)
+        transferred = os.path.getsize(tmp_path) - offset
+    if os.path.getsize(tmp_path) != size:
+        raise CIReleasePublisherError('Downloaded {} bytes of "{}" but expected {} bytes.'.format(os.path.getsize(tmp_path), os.path.basename(dst_path), size))
+    if sha256 and sha256_file(tmp_path) != sha256:
+        # Start over on the next attempt, we can't tell which part of the file got corrupted
+        os.remove(tmp_path)
+        raise CIReleasePublisherError('SHA-256 hash of the downloaded "{}" doesn\'t match the one in the release manifest.'.format(os.path.basename(dst_path)))
+    os.replace(tmp_path, dst_path)
+    return transferred
+
+# A file object reading a release asset as it's being downloaded, which checks the size and the SHA-256 hash of the
+# asset once it's read to the end, so that an upload fed from a corrupted download fails instead of completing
+class ReleaseAssetReader:
+    def __init__(self, conn, asset, sha256):
+        self._asset = asset
+        self._sha256 = sha256
+        self._hash = hashlib.sha256()
+        self._size = 0
+        headers = dict(conn.github_headers)
+        headers['Accept'] = 'application/octet-stream'
+        self._response = conn.session.get(asset.url, headers=headers, allow_redirects=True, stream=True)
+        github_check(self._response, 'Downloading "{}"'.format(asset.name))
+
+    def read(self, size=-1):
+        data = self._response.raw.read(size if size >= 0 else None)
+        self._hash.update(data)
+        self._size += len(data)
+        if not data and size != 0:
+            if self._size != self._asset.size:
+                raise CIReleasePublisherError('Downloaded {} bytes of "{}" but expected {} bytes.'.format(self._size, self._asset.name, self._asset.size))
+            if self._hash.hexdigest() != self._sha256:
+                raise CIReleasePublisherError('SHA-256 hash of the downloaded "{}" doesn\'t match the one in the release manifest.'.format(self._asset.name))
+        return data
+
+    def close(self):
+        self._response.close()
+
+# Lists the stored artifacts of the releases along with their SHA-256 hashes from the release manifests, the hash being
+# None if the release has no manifest or the manifest doesn't list the artifact. Returns a dict mapping artifact names
+# to (release, asset, sha256), artifacts present in several releases being taken from the last of them, and a list of
+# (release, asset, sha256) of the bundle chunks made by `store --bundle`, which are named the same in every release.
+def stored_release_assets(conn, releases):
+    artifacts = {}
+    bundle_chunks = []
+    for release in releases:
+        release_assets = conn.release_assets(release)
+        # The manifest lets us verify the integrity of the downloaded artifacts
+        manifest = fetch_manifest(conn, release, release_assets)
+        release_assets = [asset for asset in release_assets if asset.name != MANIFEST_NAME]
+        print('Found {} artifacts in "{}" release{}.'.format(len(release_assets), release.tag_name, '' if manifest else ', it has no manifest to verify them against'))
+        for asset in release_assets:
+            sha256 = manifest['artifacts'][asset.name]['sha256'] if manifest and asset.name in manifest['artifacts'] else None
+            if BUNDLE_CHUNK_RE.match(asset.name):
+                bundle_chunks.append((release, asset, sha256))
+                continue
+            if asset.name in artifacts:
+                print('Warning: artifact "{}" is present in both "{}" and "{}" releases, the one from "{}" release will be used.'.format(
+                    asset.name, artifacts[asset.name][0].tag_name, release.tag_name, release.tag_name))
+            artifacts[asset.name] = (release, asset, sha256)
+    return artifacts, bundle_chunks
+
+# Downloads assets of all the releases into `dst_dir` concurrently, retrying with an exponential backoff on failure.
+# Each retry resumes the download from where the previous attempt has stopped.
+# Bundles made by `store --bundle` are downloaded into a per-release directory and unpacked into `dst_dir` afterwards.
+# If the assets were already listed by stored_release_assets(), pass them in to avoid listing them again.
+def download_artifacts(conn, releases, dst_dir, download_jobs=1, download_retries=0, stored_assets=None):
+    artifacts, bundle_chunks = stored_assets if stored_assets is not None else stored_release_assets(conn, releases)
+    assets = [(release, asset, sha256, os.path.join(dst_dir, name)) for name, (release, asset, sha256) in artifacts.items()]
+    bundle_dirs = []
+    for release, asset, sha256 in bundle_chunks:
+        bundle_dir = os.path.join(dst_dir, '.{}-bundle'.format(release.tag_name))
+        os.makedirs(bundle_dir, exist_ok=True)
+        if bundle_dir not in bundle_dirs:
+            bundle_dirs.append(bundle_dir)
+        assets.append((release, asset, sha256, os.path.join(bundle_dir, asset.name)))
+
+    def download(release_asset):
+        release, asset, sha256, dst_path = release_asset
         start_time = time.time()
-        download_artifact(github_token, asset.url, dst_dir)
+        attempt = 0
+        while True:
+            try:
+                with conn.metrics.span('download asset', 'github', asset=asset.name) as span:
+                    transferred = download_artifact(conn, asset.url, dst_path, asset.size, sha256)
+                    span['bytes'] = transferred
+                conn.metrics.count('download.bytes', transferred)
+                break
+            except (requests.exceptions.RequestException, CIReleasePublisherError, OSError) as e:
+                if attempt >= download_retries:
+                    print('\tFailed to download "{}" artifact from "{}" release: {}'.format(asset.name, release.tag_name, e))
+                    return (asset, 0, False)
+                delay = backoff_delay(attempt)
+                attempt += 1
+                conn.metrics.count('retries.download')
+                print('\tDownloading "{}" artifact failed: {}. Retrying in {:.0f} seconds ({}/{}).'.format(asset.name, e, delay, attempt, download_retries))
+                time.sleep(delay)
+        elapsed_time = time.time() - start_time
+        if transferred == 0:
+            print('\tArtifact "{}" ({:.1f} MiB) from "{}" release is already downloaded, skipping.'.format(asset.name, asset.size/1024/1024, release.tag_name))
+        else:
+            print('\tDownloaded "{}" ({:.1f} MiB{}) from "{}" release in {:.2f} seconds ({:.2f} MiB/s).'.format(
+                asset.name, asset.size/1024/1024, ', {:.1f} MiB resumed'.format((asset.size - transferred)/1024/1024) if transferred < asset.size else '',
+                release.tag_name, elapsed_time, transferred/1024/1024/max(elapsed_time, 0.001)))
+        return (asset, transferred, True)
+
+    start_time = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(download_jobs, 1)) as executor:
+        results = list(executor.map(download, assets))
+    elapsed_time = time.time() - start_time
+    transferred = sum(t for _, t, _ in results)
+    conn.metrics.add_span('download artifacts', 'phase', start_time, elapsed_time, {'bytes': transferred})
+    failed = [asset.name for asset, _, ok in results if not ok]
+    print('Downloaded {} of {} artifacts ({:.1f} MiB transferred) in {:.2f} seconds ({:.2f} MiB/s) using {} download jobs.'.format(
+        len(results) - len(failed), len(results), transferred/1024/1024, elapsed_time, transferred/1024/1024/max(elapsed_time, 0.001), download_jobs))
+    if failed:
+        raise CIReleasePublisherError('Failed to download {} artifacts: {}. Run "collect" again to resume the downloads.'.format(
+            len(failed), ', '.join('"{}"'.format(f) for f in failed)))
+    for bundle_dir in bundle_dirs:
+        unbundle_artifacts([os.path.join(bundle_dir, f) for f in os.listdir(bundle_dir) if BUNDLE_CHUNK_RE.match(f)], dst_dir)
+        shutil.rmtree(bundle_dir)
+    print('All artifacts are downloaded.')
+
+# Artifacts are read in blocks of this size and each upload buffers at most UPLOAD_MAX_BLOCKS of them, so the memory
+# used by an upload doesn't depend on the artifact size
+UPLOAD_BLOCK_SIZE = 256*1024
+UPLOAD_MAX_BLOCKS = 4
+# How often to report progress of an upload, in seconds
+UPLOAD_PROGRESS_INTERVAL = 10
+
+# Returns the peak resident set size of this process in bytes, or None if it's not known on this platform
+def peak_rss():
+    if not resource:
+        return None
+    # ru_maxrss is in KiB on Linux but in bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+# A file object for an upload to read the artifact from, which is fed blocks of the artifact by the single reader of
+# the artifact file shared by all uploads of the artifact. It holds at most a few blocks, so that the uploads can't
+# run too far ahead of each other and the memory use stays constant.
+class FanOutReader:
+    def __init__(self, size, max_blocks=UPLOAD_MAX_BLOCKS):
+        self._size = size
+        self._blocks = queue.Queue(max_blocks)
+        self._block = memoryview(b'')
+        self._eof = False
+        self._aborted = False
+        # Number of bytes the upload has read so far
+        self.position = 0
+        # Set once the upload stops reading, e.g. because it has failed
+        self.closed = False
+
+    def __len__(self):
+        return self._size
+
+    # Returns False if the block wasn't added because the upload doesn't read anymore
+    def put(self, block):
+        while not self.closed:
+            try:
+                self._blocks.put(block, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    # Makes the upload fail on the next read, as there is nothing more to read
+    def abort(self):
+        self._aborted = True
+
+    def read(self, size=-1):
+        while not self._block and not self._eof:
+            if self._aborted:
+                raise OSError('Reading the artifact has failed.')
+            try:
+                block = self._blocks.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            self._eof = not block
+            self._block = memoryview(block)
+        if size < 0:
+            size = len(self._block)
+        data = self._block[:size]
+        self._block = self._block[size:]
+        self.position += len(data)
+        return data
+
+# Uploads an artifact to several releases at the same time, reading it only once from the file object returned by
+# `open_artifact`. Returns a list of (release, error) of the uploads that have failed.
+def fan_out_upload(conn, releases, name, size, open_artifact):
+    readers = [FanOutReader(size) for _ in releases]
+    start_time = time.time()
+    reported_at = start_time
+
+    def report_progress():
+        # The slowest upload is what we are waiting for
+        uploaded = min(reader.position for reader in readers)
         elapsed_time = time.time() - start_time
-        print(' Done in {:.2f} seconds.'.format(elapsed_time))
-    print('All artifacts from "{}" release are downloaded.'.format(release.tag_name))
-
-def upload_artifacts(src_dir, release):
-    print('Uploading artifacts to "{}" release.'.format(release.tag_name))
-    artifacts = sorted(os.listdir(src_dir))
-    print('Found {} artifacts in "{}" directory.'.format(len(artifacts), src_dir))
-    for artifact in artifacts:
+        print('\tUploading "{}": {:.1f} of {:.1f} MiB ({:.0f}%), {:.2f} MiB/s.'.format(
+            name, uploaded/1024/1024, size/1024/1024, 100*uploaded/max(size, 1), uploaded/1024/1024/max(elapsed_time, 0.001)))
+
+    def upload(release, reader):
+        try:
+            conn.upload_asset(release, name, size, reader)
+        finally:
+            reader.closed = True
+
+    read_error = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(releases)) as executor:
+        futures = [executor.submit(upload, release, reader) for release, reader in zip(releases, readers)]
+        try:
+            with contextlib.closing(open_artifact()) as f:
+                for block in iter(lambda: f.read(UPLOAD_BLOCK_SIZE), b''):
+                    if not any([reader.put(block) for reader in readers]):
+                        break
+                    if time.time() - reported_at >= UPLOAD_PROGRESS_INTERVAL:
+                        report_progress()
+                        reported_at = time.time()
+            for reader in readers:
+                reader.put(b'')
+        except (OSError, CIReleasePublisherError, requests.exceptions.RequestException, requests.packages.urllib3.exceptions.HTTPError) as e:
+            read_error = e
+            for reader in readers:
+                reader.abort()
+        errors = []
+        for release, future in zip(releases, futures):
+            try:
+                future.result()
+            except (CIReleasePublisherError, OSError) as e:
+                # The uploads fail because the reading has failed, so that's the error worth reporting
+                errors.append((release, read_error if read_error else e))
+    return errors
+
+# Uploads an artifact to all of the releases, retrying the failed uploads with an exponential backoff.
+# Returns the number of retries it took.
+def upload_artifact(conn, releases, artifact_path, retries):
+    return upload_stream(conn, releases, os.path.basename(artifact_path), os.path.getsize(artifact_path), functools.partial(open, artifact_path, 'rb'), retries)
+
+# Like upload_artifact(), but reads the artifact from the file object returned by `open_artifact`, which is called again
+# on each retry
+def upload_stream(conn, releases, artifact, size, open_artifact, retries):
+    attempt = 0
+    while True:
+        errors = fan_out_upload(conn, releases, artifact, size, open_artifact)
+        if not errors:
+            conn.metrics.count('upload.bytes', size * len(releases))
+            return attempt
+        if attempt >= retries:
+            raise errors[0][1]
+        delay = backoff_delay(attempt)
+        attempt += 1
+        conn.metrics.count('retries.upload')
+        for release, e in errors:
+            print('\tUploading "{}" artifact to "{}" release failed: {}. Retrying in {:.0f} seconds ({}/{}).'.format(
+                artifact, release.tag_name, e, delay, attempt, retries))
+        time.sleep(delay)
+        releases = [release for release, _ in errors]
+        # A failed upload can leave a half-uploaded asset behind, which would make GitHub reject the re-upload
+        # as an asset with such name already exists.
+        for release in releases:
+            for asset in conn.release_assets(release):
+                if asset.name == artifact:
+                    github_delete(conn, asset.url)
+
+# Returns sorted paths of the artifacts in a directory
+def artifact_files(src_dir):
+    artifact_paths = []
+    for artifact in sorted(os.listdir(src_dir)):
         artifact_path = os.path.join(src_dir, artifact)
-        if os.path.isfile(artifact_path):
-            print('\tStoring "{}" ({:.1f} MiB) artifact in the release...'.format(artifact, os.path.getsize(artifact_path)/1024/1024), end='', flush=True)
-            start_time = time.time()
-            release.upload_asset(artifact_path)
-            elapsed_time = time.time() - start_time
-            print(' Done in {:.2f} seconds.'.format(elapsed_time))
-    print('All artifacts for "{}" release are uploaded.'.format(release.tag_name))
-
-def delete_release(release, github_token, github_api_url, travis_repo_slug):
+        if not os.path.isfile(artifact_path):
+            continue
+        if artifact == MANIFEST_NAME:
+            print('Warning: ignoring "{}" in "{}" directory, the manifest is generated by this script.'.format(artifact, src_dir))
+            continue
+        artifact_paths.append(artifact_path)
+    return artifact_paths
+
+# Uploads the artifacts along with their manifest to one or more releases, reading each artifact only once however many
+# releases it goes to. If the manifest was already computed, pass it in to avoid hashing the artifacts again.
+def upload_artifacts(conn, src_dir, releases, upload_jobs=1, upload_retries=0, manifest=None):
+    print('Uploading artifacts to {} release{}.'.format(', '.join('"{}"'.format(release.tag_name) for release in releases), 's' if len(releases) > 1 else ''))
+    artifact_paths = artifact_files(src_dir)
+    print('Found {} artifacts in "{}" directory.'.format(len(artifact_paths), src_dir))
+    if not manifest:
+        manifest = artifacts_manifest(artifact_paths, upload_jobs)
+    sources = [(os.path.basename(path), os.path.getsize(path), functools.partial(open, path, 'rb')) for path in artifact_paths]
+    upload_sources(conn, sources, releases, upload_jobs, upload_retries, manifest)
+
+# Uploads artifacts given as (name, size, open_artifact) along with their manifest to one or more releases, see upload_stream()
+def upload_sources(conn, sources, releases, upload_jobs, upload_retries, manifest):
+    tag_names = ', '.join('"{}"'.format(release.tag_name) for release in releases)
+
+    def upload(source):
+        artifact, size, open_artifact = source
+        start_time = time.time()
+        try:
+            retries = upload_stream(conn, releases, artifact, size, open_artifact, upload_retries)
+        except (CIReleasePublisherError, OSError, requests.exceptions.RequestException, requests.packages.urllib3.exceptions.HTTPError) as e:
+            print('\tFailed to store "{}" ({:.1f} MiB) artifact in the release: {}'.format(artifact, size/1024/1024, e))
+            return (artifact, size, False)
+        elapsed_time = time.time() - start_time
+        print('\tStored "{}" ({:.1f} MiB) artifact in {} release{} in {:.2f} seconds ({:.2f} MiB/s{}).'.format(
+            artifact, size/1024/1024, len(releases), 's' if len(releases) > 1 else '', elapsed_time,
+            size/1024/1024/max(elapsed_time, 0.001), ', after {} retries'.format(retries) if retries else ''))
+        return (artifact, size, True)
+
+    start_time = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(upload_jobs, 1)) as executor:
+        results = list(executor.map(upload, sources))
+    elapsed_time = time.time() - start_time
+    uploaded_size = sum(size for _, size, ok in results if ok)
+    conn.metrics.add_span('upload artifacts', 'phase', start_time, elapsed_time, {'tag_names': [release.tag_name for release in releases], 'bytes': uploaded_size})
+    failed = [artifact for artifact, _, ok in results if not ok]
+    rss = peak_rss()
+    if rss:
+        conn.metrics.gauge('process.peak_rss', rss)
+    print('Uploaded {} of {} artifacts ({:.1f} MiB) in {:.2f} seconds ({:.2f} MiB/s) using {} upload jobs{}.'.format(
+        len(results) - len(failed), len(results), uploaded_size/1024/1024, elapsed_time, uploaded_size/1024/1024/max(elapsed_time, 0.001), upload_jobs,
+        ', peak RSS {:.1f} MiB'.format(rss/1024/1024) if rss else ''))
+    if failed:
+        raise CIReleasePublisherError('Failed to upload {} artifacts to {}: {}.'.format(len(failed), tag_names, ', '.join('"{}"'.format(f) for f in failed)))
+    # The manifest goes last, so that a release with a manifest is known to have all of the artifacts uploaded
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        manifest_path = os.path.join(tmp_dir, MANIFEST_NAME)
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        upload_artifact(conn, releases, manifest_path, upload_retries)
+    print('All artifacts for {} are uploaded.'.format(tag_names))
+
+# Makes a DELETE request to the GitHub API. The scheduler takes care of retrying it on server errors and rate limiting.
+# Returns False if there was nothing to delete, e.g. because a concurrently running job has already deleted it.
+def github_delete(conn, url):
+    with conn.metrics.span('delete', 'github', url=url):
+        response = conn.session.delete(url, headers=conn.github_headers)
+    if response.status_code == 404:
+        return False
+    github_check(response, 'Deleting "{}"'.format(url))
+    return True
+
+def delete_release(conn, release):
     print('Deleting {}release with tag name {}.'.format('draft ' if release.draft else '', release.tag_name))
-    release.delete_release()
+    # API doc: https://developer.github.com/v3/repos/releases/#delete-a-release
+    github_delete(conn, '{}/repos/{}/releases/{}'.format(conn.github_api_url, conn.travis_repo_slug, release.id))
     # Published releases create tags and we don't want to keep the tags
     if not release.draft:
         print('Deleting "{}" tag.'.format(release.tag_name))
-        github.Github(login_or_token=github_token, base_url=github_api_url).get_repo(travis_repo_slug).get_git_ref('tags/{}'.format(release.tag_name)).delete()
+        # API doc: https://developer.github.com/v3/git/refs/#delete-a-reference
+        github_delete(conn, '{}/repos/{}/git/refs/tags/{}'.format(conn.github_api_url, conn.travis_repo_slug, requests.utils.quote(release.tag_name, safe='')))
+
+# Deletes tags that have no release according to a deletion plan -- a list of (tag_name, reason) tuples
+def delete_tags(conn, plan, delete_jobs=1, dry_run=False):
+    print('{} {} tags:'.format('Would delete' if dry_run else 'Deleting', len(plan)))
+    for tag_name, reason in plan:
+        print('\ttag "{}" -- {}.'.format(tag_name, reason))
+    if dry_run or not plan:
+        return
+
+    def delete(tag_name):
+        try:
+            # API doc: https://developer.github.com/v3/git/refs/#delete-a-reference
+            github_delete(conn, '{}/repos/{}/git/refs/tags/{}'.format(conn.github_api_url, conn.travis_repo_slug, requests.utils.quote(tag_name, safe='')))
+        except CIReleasePublisherError as e:
+            print('\tFailed to delete "{}" tag: {}'.format(tag_name, e))
+            return False
+        return True
 
-def store_artifacts(artifact_dir, release_name, release_body, github_token, github_api_url, travis_url, travis_repo_slug, travis_branch, travis_commit, travis_build_number, travis_job_number, travis_job_id):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(delete_jobs, 1)) as executor:
+        results = list(executor.map(delete, [tag_name for tag_name, _ in plan]))
+    failed = [tag_name for (tag_name, _), ok in zip(plan, results) if not ok]
+    if failed:
+        raise CIReleasePublisherError('Failed to delete {} tags: {}.'.format(len(failed), ', '.join('"{}"'.format(f) for f in failed)))
+
+# Deletes releases, and tags of the published ones, according to a deletion plan -- a list of (release, reason) tuples
+# worked out beforehand. The plan is printed first, and unless it's a dry run the releases are deleted on a bounded
+# thread pool. The pool is kept small by default as GitHub's secondary rate limits don't like bursts of deletions,
+# and rate limited deletions are retried by the scheduler after the delay GitHub asks for.
+def delete_releases(conn, releases, plan, delete_jobs=1, dry_run=False):
+    print('{} {} releases and {} tags:'.format('Would delete' if dry_run else 'Deleting', len(plan), sum(1 for release, _ in plan if not release.draft)))
+    for release, reason in plan:
+        print('\t{}release "{}" -- {}.'.format('draft ' if release.draft else '', release.tag_name, reason))
+    if dry_run or not plan:
+        return
+
+    def delete(release):
+        try:
+            delete_release(conn, release)
+        except CIReleasePublisherError as e:
+            print('\tFailed to delete "{}" release: {}'.format(release.tag_name, e))
+            return False
+        return True
+
+    start_time = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(delete_jobs, 1)) as executor:
+        results = list(executor.map(delete, [release for release, _ in plan]))
+    failed = [release.tag_name for (release, _), ok in zip(plan, results) if not ok]
+    conn.metrics.add_span('delete releases', 'phase', start_time, time.time() - start_time, {'releases': len(plan)})
+    for (release, _), ok in zip(plan, results):
+        if ok:
+            releases.remove(release)
+    print('Deleted {} of {} releases in {:.2f} seconds using {} delete jobs.'.format(len(plan) - len(failed), len(plan), time.time() - start_time, delete_jobs))
+    if failed:
+        raise CIReleasePublisherError('Failed to delete {} releases: {}.'.format(len(failed), ', '.join('"{}"'.format(f) for f in failed)))
+
+def store_artifacts(conn, releases, artifact_dir, upload_jobs, upload_retries, bundle, bundle_chunk_size, release_name, release_body, travis_url, travis_branch, travis_commit, travis_build_number, travis_job_number, travis_job_id):
     # Make sure no release with such tag name already exist
-    releases = github.Github(login_or_token=github_token, base_url=github_api_url).get_repo(travis_repo_slug).get_releases()
     tag_name = 'ci-{}-{}-{}'.format(travis_branch, travis_build_number, travis_job_number)
-    if any(release.tag_name == tag_name for release in releases):
+    if tag_name in releases:
         raise CIReleasePublisherError('Release with tag name "{}" already exists. Was this job restarted? We don\'t support restarts.'.format(tag_name))
     # Create a draft release containing all the artifacts
     print('* Creating a draft release with tag name "{}".'.format(tag_name))
-    release = github.Github(login_or_token=github_token, base_url=github_api_url).get_repo(travis_repo_slug).create_git_release(
+    release = conn.create_release(
         tag=tag_name,
         name=release_name if release_name else
              'Temporary draft release {}'
@@ -164,154 +1359,944 @@ def store_artifacts(artifact_dir, release_name, release_body, github_token, gith
                 ('Auto-generated temporary draft release containing build artifacts of [Travis-CI job #{}]({}/{}/jobs/{}).\n\n'
                 'This release was created by `ci_release_publisher.py store` and will be automatically deleted by `ci_release_publisher.py cleanup` command, '
                 'so in general you should never manually delete it, unless you don\'t use the `ci_release_publisher.py` script anymore.')
-                .format(travis_job_id, travis_url, travis_repo_slug, travis_job_id),
+                .format(travis_job_id, travis_url, conn.travis_repo_slug, travis_job_id),
         draft=True,
         prerelease=True,
         target_commitish=travis_commit)
     print('Release created.')
-    upload_artifacts(args.artifact_dir, release)
+    releases.add(release)
+    if not bundle:
+        upload_artifacts(conn, artifact_dir, [release], upload_jobs, upload_retries)
+        return
+    with tempfile.TemporaryDirectory() as bundle_dir:
+        bundle_artifacts(artifact_files(artifact_dir), bundle_dir, bundle, bundle_chunk_size)
+        upload_artifacts(conn, bundle_dir, [release], upload_jobs, upload_retries)
 
 # Return all releases created by store_artifacts() for a specific build number
 def stored_releases(releases, travis_branch, travis_build_number):
-    prefix = 'ci-{}-{}-'.format(travis_branch, travis_build_number)
-    releases_stored = [r for r in releases if r.draft and r.tag_name.startswith(prefix) and re.match('^\d+$', r.tag_name[len(prefix):])]
-    releases_stored = sorted(releases_stored, key=lambda r: int(r.tag_name[len(prefix):]))
-    return releases_stored
+    return releases.stored(travis_branch, int(travis_build_number), int(travis_build_number) + 1)
 
-def collect_stored_artifacts(artifact_dir, github_token, github_api_url, travis_repo_slug, travis_branch, travis_build_number):
-    releases = github.Github(login_or_token=github_token, base_url=github_api_url).get_repo(travis_repo_slug).get_releases()
+def collect_stored_artifacts(conn, releases, artifact_dir, download_jobs, download_retries, travis_branch, travis_build_number):
     releases_stored = stored_releases(releases, travis_branch, travis_build_number)
     if not releases_stored:
         print('Couldn\'t find any draft releases with stored build artifacts for this build.')
         return
-    for release in releases_stored:
-        download_artifcats(github_token, release, artifact_dir)
+    print('Downloading artifacts from {} releases: {}.'.format(len(releases_stored), ', '.join('"{}"'.format(r.tag_name) for r in releases_stored)))
+    download_artifacts(conn, releases_stored, artifact_dir, download_jobs, download_retries)
+
+# Moves all files of `src_dir` into `dst_dir`, replacing the files that already exist there
+def merge_artifact_dir(src_dir, dst_dir):
+    for root, _, files in os.walk(src_dir):
+        dst_root = os.path.join(dst_dir, os.path.relpath(root, src_dir))
+        os.makedirs(dst_root, exist_ok=True)
+        for f in files:
+            os.replace(os.path.join(root, f), os.path.join(dst_root, f))
 
-def cleanup_draft_releases(github_token, github_api_url, travis_api_url, travis_repo_slug, travis_branch, travis_build_number, travis_tag):
-    releases = github.Github(login_or_token=github_token, base_url=github_api_url).get_repo(travis_repo_slug).get_releases()
+# Travis-CI job states of jobs that are done running
+FINISHED_JOB_STATES = ['passed', 'failed', 'errored', 'canceled']
+# How many polls to keep looking for the release of a job that has passed but whose release is not listed yet
+WAIT_RELEASE_POLLS = 3
+
+# Waits for the other jobs of this build to finish, downloading the artifacts each job has stored in the background as
+# soon as the job finishes, while the rest of the jobs are still running. Jobs of later build stages are not waited for,
+# as they can't start before this job finishes. Travis-CI is polled for the job states, at `poll_interval` seconds at
+# first and backing off up to `max_poll_interval` seconds while nothing changes, and the release list is re-fetched only
+# when some job has finished, which is cheap with the metadata cache as only the changed pages get transferred.
+def collect_stored_artifacts_wait(conn, artifact_dir, download_jobs, download_retries, timeout, poll_interval, max_poll_interval,
+                                  travis_branch, travis_build_number, travis_build_id, travis_job_number):
+    start_time = time.time()
+    travis = conn.travis()
+    interval = poll_interval
+    # Job number to the tag name of its release, or to None if the job has finished without storing anything
+    collected = {}
+    release_polls = {}
+    waited = []
+    futures = []
+    # Releases are downloaded one at a time, each with `download_jobs` concurrent downloads, into a staging directory of
+    # their own. Jobs finish in any order, so the staging directories are merged only once all the downloads are done, in
+    # the order of the job numbers, so that an artifact present in several releases comes from the release of the later
+    # job, just like in `collect`
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        while True:
+            with conn.metrics.span('build jobs', 'travis', build_id=travis_build_id):
+                jobs = travis.build_jobs(travis_build_id)
+            stages = {job['number']: (job.get('stage') or {}).get('number', 0) for job in jobs}
+            own_stage = stages.get(travis_job_number, 0)
+            waited = [job for job in jobs if job['number'] != travis_job_number and (not own_stage or stages[job['number']] <= own_stage)]
+            finished = [job for job in waited if job['state'] in FINISHED_JOB_STATES and job['number'] not in collected]
+            if finished:
+                releases = fetch_release_index(conn)
+                for job in finished:
+                    tag_name = 'ci-{}-{}-{}'.format(travis_branch, travis_build_number, job['number'].split('.')[1])
+                    release = releases.get(tag_name)
+                    if release and release.draft:
+                        print('Job #{} has {}, downloading its artifacts from "{}" release in the background.'.format(job['number'], job['state'], tag_name))
+                        collected[job['number']] = tag_name
+                        staging_dir = os.path.join(artifact_dir, '.{}-collect'.format(tag_name))
+                        os.makedirs(staging_dir, exist_ok=True)
+                        futures.append((job['number'], tag_name, staging_dir,
+                                        executor.submit(download_artifacts, conn, [release], staging_dir, download_jobs, download_retries)))
+                        continue
+                    # GitHub might not list a just created release right away
+                    release_polls[job['number']] = release_polls.get(job['number'], 0) + 1
+                    if job['state'] != 'passed' or release_polls[job['number']] >= WAIT_RELEASE_POLLS:
+                        print('Job #{} has {} without storing any artifacts.'.format(job['number'], job['state']))
+                        collected[job['number']] = None
+                interval = poll_interval
+            else:
+                interval = min(interval * 1.5, max_poll_interval)
+            pending = [job['number'] for job in waited if job['number'] not in collected]
+            remaining_time = timeout - (time.time() - start_time)
+            if not pending or remaining_time <= 0:
+                break
+            print('Waiting for {} jobs to finish: {}. Checking again in {:.1f} seconds.'.format(len(pending), ', '.join('#{}'.format(p) for p in pending), min(interval, remaining_time)))
+            time.sleep(min(interval, remaining_time))
+        failed = []
+        for job_number, tag_name, staging_dir, future in sorted(futures, key=lambda f: int(f[0].split('.')[1])):
+            try:
+                future.result()
+                merge_artifact_dir(staging_dir, artifact_dir)
+            except (requests.exceptions.RequestException, CIReleasePublisherError, OSError) as e:
+                print('Failed to collect artifacts of "{}" release: {}'.format(tag_name, e))
+                failed.append(tag_name)
+            shutil.rmtree(staging_dir, ignore_errors=True)
+    missing = [job for job in waited if collected.get(job['number']) is None]
+    print('Collected artifacts of {} of {} jobs in {:.2f} seconds.'.format(sum(1 for tag_name in collected.values() if tag_name), len(waited), time.time() - start_time))
+    if missing:
+        print('Jobs without collected artifacts:')
+        for job in missing:
+            print('\t#{}: {}'.format(job['number'], 'finished as "{}" without storing any artifacts'.format(job['state']) if job['number'] in collected
+                                     else 'still "{}" after waiting for {} seconds'.format(job['state'], timeout)))
+    if failed:
+        raise CIReleasePublisherError('Failed to collect artifacts of {} releases: {}. Run "collect" again to resume the downloads.'.format(
+            len(failed), ', '.join('"{}"'.format(f) for f in failed)))
+    timed_out = [job['number'] for job in missing if job['number'] not in collected]
+    if timed_out:
+        raise CIReleasePublisherError('Timed out after {} seconds waiting for {} jobs to finish: {}.'.format(timeout, len(timed_out), ', '.join('#{}'.format(t) for t in timed_out)))
+
+def cleanup_draft_releases(conn, releases, delete_jobs, dry_run, travis_branch, travis_build_number, travis_tag):
     print('* Deleting draft releases created to store per-job atifacts.')
     # When a tag is pushed, we create ci-<tag>-<build_number>-<job_number> releases
     # When no tag is pushed, we create ci-<branch_name>-<build_number>-<job_number> releases
-    prefix = 'ci-{}-'.format(travis_branch if not travis_tag else travis_tag)
+    plan = []
     # If this build is caused by a tag push, then we don't want to clean up previous stored releases
     if not travis_tag:
         # We don't want to delete releases being used by another build running for this branch, so let's find out which builds are running
         # and skip deleting releases for them.
-        branch_unfinished_build_numbers = Travis.github_auth(github_token, travis_api_url).branch_unfinished_build_numbers(travis_repo_slug, travis_branch)
-        releases_stored_previous = [r for r in releases if r.draft and r.tag_name.startswith(prefix) and re.match('^\d+-\d+$', r.tag_name[len(prefix):]) and
-            int(r.tag_name[len(prefix):].split('-')[0]) < int(travis_build_number) and int(r.tag_name[len(prefix):].split('-')[0]) not in branch_unfinished_build_numbers]
-        releases_stored_previous = sorted(releases_stored_previous, key=lambda r: int(r.tag_name[len(prefix):].split('-')[1]))
-        releases_stored_previous = sorted(releases_stored_previous, key=lambda r: int(r.tag_name[len(prefix):].split('-')[0]))
-        for release in releases_stored_previous:
-            delete_release(release, github_token, github_api_url, travis_repo_slug)
-    for release in stored_releases(releases, travis_branch if not travis_tag else travis_tag, travis_build_number):
-        delete_release(release, github_token, github_api_url, travis_repo_slug)
-    print('All draft releases created to store per-job atifacts are deleted.')
-
-def publish_numbered_release(releases, artifact_dir, numbered_release_keep_count, numbered_release_keep_time, numbered_release_name, numbered_release_body, numbered_release_draft, numbered_release_prerelease, github_token, github_api_url, travis_url, travis_repo_slug, travis_branch, travis_commit, travis_build_number, travis_build_id):
-    tag_name = 'ci-{}-{}'.format(travis_branch, travis_build_number)
-    print('* Starting the procedure of creating a numbered release with tag name "{}".'.format(tag_name))
-    if any(release.tag_name == tag_name for release in releases):
-        raise CIReleasePublisherError('Release with tag name "{}" already exists. Was this job restarted? We don\'t support restarts.'.format(tag_name))
-    prefix = 'ci-{}-'.format(travis_branch)
-    previous_numbered_releases = [r for r in releases if r.tag_name.startswith(prefix) and re.match('^\d+$', r.tag_name[len(prefix):])
-                                  and int(r.tag_name[len(prefix):]) < int(travis_build_number)]
-    previous_numbered_releases = sorted(previous_numbered_releases, key=lambda r: int(r.tag_name[len(prefix):]))
-    if numbered_release_keep_count > 0:
-        print('Keeping only {} numbered releases for "{}" branch.'.format(numbered_release_keep_count, travis_branch))
-        extra_numbered_releases_to_remove = (len(previous_numbered_releases) + 1) - numbered_release_keep_count
+        with conn.metrics.span('unfinished builds', 'travis', branch=travis_branch):
+            branch_unfinished_build_numbers = conn.travis().branch_unfinished_build_numbers(conn.travis_repo_slug, travis_branch)
+        releases_stored_previous = [r for r in releases.stored(travis_branch, None, travis_build_number)
+                                    if int(r.tag_name[len('ci-{}-'.format(travis_branch)):].split('-')[0]) not in branch_unfinished_build_numbers]
+        plan.extend((release, 'stored by a previous finished build') for release in releases_stored_previous)
+    plan.extend((release, 'stored by this build') for release in stored_releases(releases, travis_branch if not travis_tag else travis_tag, travis_build_number))
+    delete_releases(conn, releases, plan, delete_jobs, dry_run)
+    if not dry_run:
+        print('All draft releases created to store per-job atifacts are deleted.')
+
+# Returns the (kind, branch, build_number) a CI release or tag name stands for, or None if it's not one of ours. The kind
+# is prefixed with "temporary " for the `_ci-*` releases made by `publish` before they get their final name. Tag names
+# can be ambiguous, e.g. "ci-a-1-2" is either stored by job 2 of build 1 of "a" branch or numbered of build 2 of "a-1"
+# branch, in which case the branch that exists is preferred and then drafts are taken to be stored releases.
+def classify_tag_name(tag_name, draft, known_branches):
+    temporary = tag_name.startswith('_ci-')
+    keys = ReleaseIndex.parse_tag_name(tag_name[1:] if temporary else tag_name)
+    if temporary:
+        keys = [key for key in keys if key[0] != 'stored']
+    keys = [key for key in keys if key[1] in known_branches] or keys
+    if not keys:
+        return None
+    kinds = [kind for kind, _, _, _ in keys]
+    preference = ['stored', 'numbered', 'latest'] if draft else ['numbered', 'latest', 'stored']
+    kind, branch, build_number, _ = keys[kinds.index([kind for kind in preference if kind in kinds][0])]
+    return ('temporary ' if temporary else '') + kind, branch, build_number
+
+# Deletes CI releases and tags that are no longer needed across the whole repository, looking at all branches at once:
+#  - stored releases of finished builds, which `cleanup` didn't get to delete, e.g. because the build has failed
+#  - temporary `_ci-*` releases of finished builds left behind by crashed `publish` runs
+#  - numbered releases that don't fit the keep-count and keep-time retention policy, per branch
+#  - numbered and latest releases of branches that no longer exist, if asked to
+#  - `ci-*` and `_ci-*` tags that have no release, left behind by interrupted deletions
+# Releases and tags of builds that have not finished yet are never deleted, as those builds might still be using them.
+def collect_garbage(conn, releases, delete_jobs, dry_run, keep_count, keep_time, delete_stale_branches):
+    print('* Collecting garbage CI releases and tags of all branches.')
+    start_time = time.time()
+    # API doc: https://developer.github.com/v3/git/refs/#list-matching-references
+    tag_names = [ref['ref'][len('refs/tags/'):] for ref in fetch_github_list(conn, '{}/repos/{}/git/matching-refs/tags/'.format(conn.github_api_url, conn.travis_repo_slug))]
+    # API doc: https://developer.github.com/v3/repos/branches/#list-branches
+    branch_names = [branch['name'] for branch in fetch_github_list(conn, '{}/repos/{}/branches'.format(conn.github_api_url, conn.travis_repo_slug))]
+    # Releases of tag builds are named after the tag instead of the branch
+    known_branches = set(branch_names) | set(tag_name for tag_name in tag_names if not ReleaseIndex.parse_tag_name(tag_name.lstrip('_')))
+    with conn.metrics.span('unfinished builds', 'travis'):
+        unfinished_build_numbers = conn.travis().unfinished_build_numbers(conn.travis_repo_slug)
+    print('Found {} releases, {} tags and {} branches. {} builds across {} branches have not finished yet.'.format(
+        len(releases), len(tag_names), len(branch_names), sum(len(b) for b in unfinished_build_numbers.values()), len(unfinished_build_numbers)))
+
+    def is_unfinished(branch, build_number):
+        if build_number is None:
+            return bool(unfinished_build_numbers.get(branch))
+        return build_number in unfinished_build_numbers.get(branch, set())
+
+    plan = []
+    numbered = {}
+    for release in releases:
+        classified = classify_tag_name(release.tag_name, release.draft, known_branches)
+        if not classified:
+            continue
+        kind, branch, build_number = classified
+        if is_unfinished(branch, build_number):
+            continue
+        if kind == 'stored' and release.draft:
+            plan.append((release, 'stored by a finished build'))
+        elif kind.startswith('temporary '):
+            plan.append((release, 'left behind by a crashed publish'))
+        elif delete_stale_branches and branch not in known_branches and kind in ('numbered', 'latest'):
+            plan.append((release, '"{}" branch no longer exists'.format(branch)))
+        elif kind == 'numbered':
+            numbered.setdefault(branch, []).append((build_number, release))
+    for branch in sorted(numbered):
+        numbered_releases = [release for _, release in sorted(numbered[branch], key=lambda entry: entry[0])]
+        plan.extend(numbered_release_retention_plan(numbered_releases, keep_count, keep_time, branch))
+    tag_plan = []
+    for tag_name in tag_names:
+        if tag_name in releases:
+            continue
+        classified = classify_tag_name(tag_name, False, known_branches)
+        if classified and not is_unfinished(classified[1], classified[2]):
+            tag_plan.append((tag_name, 'has no release'))
+    conn.metrics.add_span('plan gc', 'phase', start_time, time.time() - start_time, {'releases': len(plan), 'tags': len(tag_plan)})
+    delete_releases(conn, releases, plan, delete_jobs, dry_run)
+    delete_tags(conn, tag_plan, delete_jobs, dry_run)
+    if not dry_run:
+        print('Garbage collection is done.')
+
+# Returns a timezone-aware UTC datetime. Older PyGithub versions return naive datetimes of GitHub's UTC timestamps.
+def utc_datetime(dt):
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=datetime.timezone.utc)
+    return dt.astimezone(datetime.timezone.utc)
+
+# Returns a deletion plan of numbered releases of a branch, sorted by build number, that don't fit the keep-count and
+# keep-time retention policy. `new_release_count` is the number of numbered releases about to be made for the branch.
+def numbered_release_retention_plan(numbered_releases, keep_count, keep_time, branch, new_release_count=0):
+    plan = []
+    if keep_count > 0:
+        print('Keeping only {} numbered releases for "{}" branch.'.format(keep_count, branch))
+        extra_numbered_releases_to_remove = (len(numbered_releases) + new_release_count) - keep_count
         if extra_numbered_releases_to_remove < 0:
             extra_numbered_releases_to_remove = 0
-        print('Found {} numbered releases for "{}" branch. Accounting for the one we are about to make, {} of existing numbered releases must be deleted.'.format(
-            len(previous_numbered_releases), travis_branch, extra_numbered_releases_to_remove))
-        for release in previous_numbered_releases[:extra_numbered_releases_to_remove]:
-            delete_release(release, github_token, github_api_url, travis_repo_slug)
-        previous_numbered_releases = previous_numbered_releases[extra_numbered_releases_to_remove:]
-    if numbered_release_keep_time > 0:
-        expired_previous_numbered_releases = [r for r in previous_numbered_releases if (datetime.datetime.now() - r.created_at).total_seconds() > numbered_release_keep_time]
-        print('Keeping only numbered releases that are not older than {} seconds for "{}" branch.'.format(numbered_release_keep_time, travis_branch))
+        print('Found {} numbered releases for "{}" branch. {}{} of existing numbered releases must be deleted.'.format(
+            len(numbered_releases), branch, 'Accounting for the one we are about to make, ' if new_release_count else '', extra_numbered_releases_to_remove))
+        plan.extend((release, 'exceeds the keep count of {}'.format(keep_count))
+                    for release in numbered_releases[:extra_numbered_releases_to_remove])
+        numbered_releases = numbered_releases[extra_numbered_releases_to_remove:]
+    if keep_time > 0:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        expired_numbered_releases = [r for r in numbered_releases if (now - utc_datetime(r.created_at)).total_seconds() > keep_time]
+        print('Keeping only numbered releases that are not older than {} seconds for "{}" branch.'.format(keep_time, branch))
         print('Found {} numbered releases for "{}" branch. {} of them will be deleted due to being too old.'.format(
-            len(previous_numbered_releases), travis_branch, len(expired_previous_numbered_releases)))
-        for release in expired_previous_numbered_releases:
-            delete_release(release, github_token, github_api_url, travis_repo_slug)
-        previous_numbered_releases = [r for r in previous_numbered_releases if r not in expired_previous_numbered_releases]
+            len(numbered_releases), branch, len(expired_numbered_releases)))
+        plan.extend((release, 'older than {} seconds'.format(keep_time)) for release in expired_numbered_releases)
+    return plan
+
+# Publishing a release is split in two, so that the artifacts are uploaded to all of the releases being published in a
+# single pass: start_*_release() creates a draft release to upload the artifacts to and returns it along with a function
+# finishing the release once the artifacts are uploaded, or it returns None if there is nothing to publish.
+
+def start_numbered_release(conn, releases, delete_jobs, numbered_release_keep_count, numbered_release_keep_time, numbered_release_name, numbered_release_body, numbered_release_draft, numbered_release_prerelease, travis_url, travis_branch, travis_commit, travis_build_number, travis_build_id):
+    tag_name = 'ci-{}-{}'.format(travis_branch, travis_build_number)
+    print('* Starting the procedure of creating a numbered release with tag name "{}".'.format(tag_name))
+    if tag_name in releases:
+        raise CIReleasePublisherError('Release with tag name "{}" already exists. Was this job restarted? We don\'t support restarts.'.format(tag_name))
+    plan = numbered_release_retention_plan(releases.numbered(travis_branch, None, travis_build_number), numbered_release_keep_count,
+                                           numbered_release_keep_time, travis_branch, 1)
+    delete_releases(conn, releases, plan, delete_jobs)
     tag_name_tmp = '_{}'.format(tag_name)
     print('Creating a numbered draft release with tag name "{}".'.format(tag_name_tmp))
-    release = github.Github(login_or_token=github_token, base_url=github_api_url).get_repo(travis_repo_slug).create_git_release(
+    release = conn.create_release(
         tag=tag_name_tmp,
         name=numbered_release_name if numbered_release_name else
              'CI build of {} branch #{}'.format(travis_branch, travis_build_number),
         message=numbered_release_body if numbered_release_body else
                 'This is an auto-generated release based on [Travis-CI build #{}]({}/{}/builds/{})'
-                .format(travis_build_id, travis_url, travis_repo_slug, travis_build_id),
+                .format(travis_build_id, travis_url, conn.travis_repo_slug, travis_build_id),
         draft=True,
         prerelease=numbered_release_prerelease,
         target_commitish=travis_commit)
-    upload_artifacts(artifact_dir, release)
-    print('Changing the tag name from "{}" to "{}"{}.'.format(tag_name_tmp, tag_name, '' if numbered_release_draft else ' and removing the draft flag'))
-    release.update_release(name=release.title, message=release.body, draft=numbered_release_draft, prerelease=numbered_release_prerelease, tag_name=tag_name)
 
-def publish_latest_release(releases, artifact_dir, latest_release_name, latest_release_body, latest_release_draft, latest_release_prerelease, github_token, github_api_url, travis_api_url, travis_url, travis_repo_slug, travis_branch, travis_commit, travis_build_number, travis_build_id):
+    def finish(release):
+        print('Changing the tag name from "{}" to "{}"{}.'.format(tag_name_tmp, tag_name, '' if numbered_release_draft else ' and removing the draft flag'))
+        release = conn.update_release(release, name=release.title, message=release.body, draft=numbered_release_draft, prerelease=numbered_release_prerelease, tag_name=tag_name)
+        releases.add(release)
+
+    return release, finish
+
+# Name of the asset of a numbered release describing the binary delta patches of its artifacts from the artifacts of
+# the previous numbered release, which is uploaded after all of the patches
+PATCH_MANIFEST_NAME = 'PATCHES.json'
+
+# Returns the zstd window log needed for the patch to reference all of the base, like `zstd --patch-from` does
+def patch_window_log(size):
+    return min(max(size.bit_length(), 10), 31)
+
+# Makes a binary delta patch of the target artifact from the base one, which is a zstd frame compressed using the base
+# as a raw content dictionary, just like `zstd --patch-from=<base> <target>` makes. Matches can be anywhere in the base,
+# so the hash and chain tables get about an entry per byte of the window, taking 8 bytes of memory per byte of the base,
+# anything smaller makes the patches several times larger.
+# Runs in a worker process. Returns the size and the SHA-256 hash of the patch.
+def make_patch(base_path, target_path, patch_path, level):
+    target_size = os.path.getsize(target_path)
+    window_log = patch_window_log(max(os.path.getsize(base_path), target_size))
+    with open(base_path, 'rb') as f:
+        base = zstandard.ZstdCompressionDict(f.read(), dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+    params = zstandard.ZstdCompressionParameters.from_level(level, source_size=target_size, window_log=window_log, hash_log=min(window_log - 1, 30),
+                                                            chain_log=min(window_log - 1, 30), enable_ldm=True)
+    with open(target_path, 'rb') as src, open(patch_path, 'wb') as dst:
+        zstandard.ZstdCompressor(dict_data=base, compression_params=params).copy_stream(src, dst, size=target_size)
+    return os.path.getsize(patch_path), sha256_file(patch_path)
+
+# Returns a process pool for making the patches whose workers are spawned rather than forked, as forking while our
+# upload and download threads hold locks, e.g. of the HTTP connection pool, can deadlock the workers. Python 3.6 can't
+# pick the start method of a ProcessPoolExecutor, but it starts all of the workers on the first submit, so they are
+# started right away, before any of the patching threads.
+def patch_process_pool(max_workers):
+    try:
+        return concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+    except TypeError:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+        executor.submit(os.getpid).result()
+        return executor
+
+# Re-creates the target artifact from the base one and a patch made by make_patch(), `zstd -d --long=31 --patch-from=<base>`
+# does the same
+def apply_patch(base_path, patch_path, dst_path):
+    with open(base_path, 'rb') as f:
+        base = zstandard.ZstdCompressionDict(f.read(), dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+    with open(patch_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        zstandard.ZstdDecompressor(dict_data=base, max_window_size=2**31).copy_stream(src, dst)
+
+# Finish function of a started release that also has an abort(), which is to be called if the release is not going to
+# be finished, e.g. because uploading the artifacts has failed, to stop the background work the release has started.
+# Calling abort() after the release is finished does nothing.
+class AbortableFinish:
+    def __init__(self, finish, abort):
+        self._finish = finish
+        self.abort = abort
+
+    def __call__(self, release):
+        self._finish(release)
+
+# Calls abort() of the started releases that have one, see AbortableFinish
+def abort_releases(started_releases):
+    for started in started_releases:
+        if started and isinstance(started[1], AbortableFinish):
+            started[1].abort()
+
+# Starts making binary delta patches of the changed artifacts from the same-named assets of the previous numbered
+# release of the branch. The previous assets are downloaded and the patches are made in a process pool in the
+# background, while the artifacts are being uploaded. Returns the started numbered release with its finish wrapped in
+# an AbortableFinish that uploads the patches and their manifest before finishing the release. Patches that fail or
+# that turn out no smaller than the artifact are left out, they are an optimization and shouldn't fail the publishing.
+# The previous numbered release is looked up after start_numbered_release() has applied the retention policy, so with
+# a keep count of 1 there is no previous release left to make the patches from.
+def start_numbered_release_patches(conn, releases, started_release, manifest, artifact_dir, download_jobs, download_retries, upload_jobs, upload_retries,
+                                   patch_jobs, patch_level, travis_branch, travis_build_number):
+    if not started_release:
+        return started_release
+    print('* Starting making binary delta patches from the previous numbered release.')
+    previous_releases = releases.numbered(travis_branch, None, travis_build_number)
+    if not previous_releases:
+        print('There is no previous numbered release to make the patches from, the retention policy might have deleted it.')
+        return started_release
+    base_release = previous_releases[-1]
+    base_build_number = base_release.tag_name[len('ci-{}-'.format(travis_branch)):]
+    base_assets = {asset.name: asset for asset in conn.release_assets(base_release)}
+    base_manifest = fetch_manifest(conn, base_release, base_assets.values())
+    if not base_manifest:
+        print('The previous numbered release "{}" has no manifest, not making the patches.'.format(base_release.tag_name))
+        return started_release
+    names = [name for name, artifact in sorted(manifest['artifacts'].items())
+             if name in base_assets and name in base_manifest['artifacts'] and base_manifest['artifacts'][name]['sha256'] != artifact['sha256']]
+    print('{} of {} artifacts have changed since "{}" release.'.format(len(names), len(manifest['artifacts']), base_release.tag_name))
+    if not names:
+        return started_release
+    tmp_dir = tempfile.mkdtemp()
+    process_executor = patch_process_pool(patch_jobs)
+    thread_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(download_jobs, patch_jobs))
+    aborted = threading.Event()
+    closed = threading.Event()
+
+    def make(name):
+        if aborted.is_set():
+            raise CIReleasePublisherError('Making the patches was aborted.')
+        asset = base_assets[name]
+        base_path = os.path.join(tmp_dir, '{}.base'.format(name))
+        attempt = 0
+        while True:
+            try:
+                with conn.metrics.span('download asset', 'github', asset=name) as span:
+                    span['bytes'] = download_artifact(conn, asset.url, base_path, asset.size, base_manifest['artifacts'][name]['sha256'])
+                break
+            except (requests.exceptions.RequestException, CIReleasePublisherError, OSError) as e:
+                if attempt >= download_retries:
+                    raise
+                delay = backoff_delay(attempt)
+                attempt += 1
+                conn.metrics.count('retries.download')
+                print('\tDownloading "{}" artifact failed: {}. Retrying in {:.0f} seconds ({}/{}).'.format(name, e, delay, attempt, download_retries))
+                time.sleep(delay)
+        if aborted.is_set():
+            os.remove(base_path)
+            raise CIReleasePublisherError('Making the patches was aborted.')
+        patch_path = os.path.join(tmp_dir, '{}.patch-from-{}.zst'.format(name, base_build_number))
+        start_time = time.time()
+        size, sha256 = process_executor.submit(make_patch, base_path, os.path.join(artifact_dir, name), patch_path, patch_level).result()
+        conn.metrics.add_span('make patch', 'patch', start_time, time.time() - start_time, {'asset': name, 'bytes': size})
+        os.remove(base_path)
+        print('\tMade a patch of "{}" ({:.1f} MiB) from "{}" release, {:.1f} MiB, in {:.2f} seconds.'.format(
+            name, manifest['artifacts'][name]['size']/1024/1024, base_release.tag_name, size/1024/1024, time.time() - start_time))
+        return patch_path, size, sha256
+
+    futures = [(name, thread_executor.submit(make, name)) for name in names]
+    release, finish = started_release
+
+    # The patches are optional, so failing to upload them shouldn't fail the release. Any partly uploaded patches are
+    # deleted, as they are of no use without the patch manifest.
+    def upload_patches(release, patches):
+        print('Uploading {} patches to "{}" release.'.format(len(patches), release.tag_name))
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(upload_jobs, 1)) as executor:
+                list(executor.map(lambda patch: upload_artifact(conn, [release], os.path.join(tmp_dir, patch['name']), upload_retries), patches.values()))
+            # The patch manifest goes last, so that a release with it is known to have all of the patches uploaded
+            patch_manifest_path = os.path.join(tmp_dir, PATCH_MANIFEST_NAME)
+            with open(patch_manifest_path, 'w') as f:
+                json.dump({'algorithm': 'zstd-patch-from', 'base_release': base_release.tag_name, 'patches': patches}, f, indent=2, sort_keys=True)
+            upload_artifact(conn, [release], patch_manifest_path, upload_retries)
+        except (requests.exceptions.RequestException, CIReleasePublisherError, OSError) as e:
+            print('Warning: failed to upload the patches, publishing the release without them: {}'.format(e))
+            patch_asset_names = set(patch['name'] for patch in patches.values()) | {PATCH_MANIFEST_NAME}
+            try:
+                for asset in conn.release_assets(release):
+                    if asset.name in patch_asset_names:
+                        print('Deleting partly uploaded "{}" patch asset.'.format(asset.name))
+                        github_delete(conn, asset.url)
+            except (requests.exceptions.RequestException, CIReleasePublisherError) as e:
+                print('Warning: failed to delete the partly uploaded patches: {}'.format(e))
+            return
+        print('Uploaded patches of {} artifacts ({:.1f} MiB instead of {:.1f} MiB).'.format(
+            len(patches), sum(p['size'] for p in patches.values())/1024/1024, sum(manifest['artifacts'][n]['size'] for n in patches)/1024/1024))
+
+    def finish_with_patches(release):
+        try:
+            patches = {}
+            for name, future in futures:
+                try:
+                    patch_path, size, sha256 = future.result()
+                except (requests.exceptions.RequestException, CIReleasePublisherError, OSError, MemoryError, zstandard.ZstdError,
+                        concurrent.futures.process.BrokenProcessPool) as e:
+                    print('Warning: failed to make a patch of "{}" artifact: {}'.format(name, e))
+                    continue
+                if size >= manifest['artifacts'][name]['size']:
+                    print('Patch of "{}" artifact is no smaller than the artifact itself, leaving it out.'.format(name))
+                    continue
+                patches[name] = {
+                    'name': os.path.basename(patch_path),
+                    'sha256': sha256,
+                    'size': size,
+                    'base_sha256': base_manifest['artifacts'][name]['sha256'],
+                }
+            if patches:
+                upload_patches(release, patches)
+        finally:
+            close()
+        finish(release)
+
+    def close():
+        if closed.is_set():
+            return
+        closed.set()
+        thread_executor.shutdown()
+        process_executor.shutdown()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    # Pending downloads and patches are cancelled, the ones in progress are waited for, as the temporary directory
+    # can't be removed while they are still writing to it
+    def abort():
+        if closed.is_set():
+            return
+        print('Aborting making the patches of "{}" release.'.format(release.tag_name))
+        aborted.set()
+        for _, future in futures:
+            future.cancel()
+        close()
+
+    return release, AbortableFinish(finish_with_patches, abort)
+
+# Prefix of the references the leases of latest releases live in, followed by the branch name. Branch names are valid
+# reference names and can't clash with each other, so neither can these.
+LEASE_REF_PREFIX = 'refs/ci-release-publisher/leases/latest/'
+# Tree of the lease commits, the empty tree is known to every Git repository
+LEASE_TREE_SHA = '4b825dc642cb6eb9a060e54bf8d69288fbee4904'
+# A lease that stays in the "swapping" state for longer than this, in seconds, is considered to be left by a crashed run
+LEASE_SWAP_TIMEOUT = 10*60
+# How many times to retry taking the lease after losing a race for it to another build
+LEASE_ACQUIRE_RETRIES = 5
+
+# Lease of the "ci-<branch>-latest" release, which coordinates builds of a branch publishing it at the same time.
+#
+# Each state of the lease is a "<LEASE_REF_PREFIX><branch>/<generation>" reference to a parentless commit whose message
+# holds the build number of the build owning the lease, what it's doing and the id of the current latest release. The
+# state with the highest generation is the current one. The lease changes hands only by creating the reference of the
+# next generation, which GitHub does atomically, so only one of several builds racing for the lease succeeds and the
+# others find out right away. The older generations are deleted after each change, so neither the references nor the
+# commits pile up. A build takes over the lease from older builds and bails out when it sees a newer one, without
+# asking Travis-CI which build is the last one.
+class LatestReleaseLease:
+    def __init__(self, conn, branch, build_number):
+        self._conn = conn
+        self._ref_prefix = '{}{}/'.format(LEASE_REF_PREFIX, branch)
+        self._build_number = int(build_number)
+        self._generation = None
+        # Build number of the newer build the lease was lost to
+        self.newer_build_number = None
+        # Id of the current latest release, or None if it's not known, e.g. when the lease is used for the first time
+        self.release_id = None
+
+    # Returns the generations of the lease that exist, sorted
+    def _generations(self):
+        # API doc: https://developer.github.com/v3/git/refs/#list-matching-references
+        refs = fetch_github_list(self._conn, '{}/repos/{}/git/matching-refs/{}'.format(
+            self._conn.github_api_url, self._conn.travis_repo_slug, requests.utils.quote(self._ref_prefix[len('refs/'):])))
+        # Leases of "<branch>/..." branches share the prefix
+        return sorted((int(ref['ref'][len(self._ref_prefix):]), ref['object']['sha']) for ref in refs if re.fullmatch('[0-9]+', ref['ref'][len(self._ref_prefix):]))
+
+    # Returns the current (generation, state) of the lease, (0, None) if it was never taken
+    def _read(self):
+        generations = self._generations()
+        if not generations:
+            return 0, None
+        generation, sha = generations[-1]
+        message = self._conn.git_commit_message(sha)
+        try:
+            return generation, json.loads(message.split('\n\n', 1)[1])
+        except (IndexError, ValueError):
+            return generation, None
+
+    # Writes the state as the next generation after `generation`. Returns False if some other build has written it first.
+    def _write(self, generation, state):
+        state = dict(state, build_number=self._build_number)
+        message = 'Lease of the latest release of build #{}: {}\n\n{}'.format(self._build_number, state['state'], json.dumps(state, sort_keys=True))
+        sha = self._conn.create_git_commit(message, LEASE_TREE_SHA, [])
+        if not self._conn.create_git_ref('{}{}'.format(self._ref_prefix, generation + 1), sha):
+            return False
+        # The reference of the generation could have been deleted by the time we have created it again, so we check that
+        # no later generation exists. If it does, the other build has won. The older generations are of no use anymore.
+        generations = self._generations()
+        if generations and generations[-1][0] > generation + 1:
+            return False
+        self._generation = generation + 1
+        for old_generation, _ in generations[:-1]:
+            # Other builds delete the old generations too, GitHub responds with 422 to deleting one that is already gone
+            # API doc: https://developer.github.com/v3/git/refs/#delete-a-reference
+            try:
+                github_delete(self._conn, '{}/repos/{}/git/refs/{}'.format(self._conn.github_api_url, self._conn.travis_repo_slug,
+                                                                          requests.utils.quote('{}{}'.format(self._ref_prefix[len('refs/'):], old_generation))))
+            except (requests.exceptions.RequestException, CIReleasePublisherError):
+                pass
+        return True
+
+    # Takes the lease over from older builds. Returns False if a newer build has it. Waits for an older build that is in
+    # the middle of swapping the releases to finish, so that we know which release it has made the latest one. Losing
+    # the race for the lease to another build is retried with a backoff a few times, as it might be an older build.
+    def acquire(self):
+        attempt = 0
+        lost_races = 0
+        while True:
+            generation, state = self._read()
+            if state and state['build_number'] > self._build_number:
+                self.newer_build_number = state['build_number']
+                return False
+            release_id = state.get('release_id') if state else None
+            if state and state['state'] == 'swapping' and state['build_number'] != self._build_number:
+                if time.time() < state['expires_at']:
+                    delay = backoff_delay(attempt)
+                    attempt += 1
+                    print('Build #{} is swapping the latest release, waiting {:.0f} seconds for it to finish.'.format(state['build_number'], delay))
+                    time.sleep(delay)
+                    continue
+                print('Build #{} has not finished swapping the latest release in {} seconds, taking over.'.format(state['build_number'], LEASE_SWAP_TIMEOUT))
+                # We don't know whether it has managed to publish its release
+                release_id = None
+            if self._write(generation, {'state': 'uploading', 'release_id': release_id}):
+                self.release_id = release_id
+                return True
+            if lost_races >= LEASE_ACQUIRE_RETRIES:
+                raise CIReleasePublisherError('Failed to take the lease "{}" after losing {} races for it to other builds.'.format(
+                    self._ref_prefix, lost_races + 1))
+            delay = backoff_delay(lost_races)
+            lost_races += 1
+            print('Another build has taken the lease of the latest release first, retrying in {:.0f} seconds ({}/{}).'.format(
+                delay, lost_races, LEASE_ACQUIRE_RETRIES))
+            time.sleep(delay)
+
+    # Marks the start of swapping the releases with a single write of the next generation, which fails if any other
+    # build has taken the lease since we acquired it. Returns False if the lease was lost.
+    def swap(self):
+        if self._write(self._generation, {'state': 'swapping', 'release_id': self.release_id, 'expires_at': int(time.time()) + LEASE_SWAP_TIMEOUT}):
+            return True
+        _, state = self._read()
+        self.newer_build_number = state['build_number'] if state else None
+        return False
+
+    # Records the release that is now the latest one
+    def release(self, release_id):
+        self.release_id = release_id
+        if not self._write(self._generation, {'state': 'published', 'release_id': release_id}):
+            raise CIReleasePublisherError('Lease "{}" was taken over while this build was swapping the latest release.'.format(self._ref_prefix))
+
+def start_latest_release(conn, releases, manifest, latest_release_name, latest_release_body, latest_release_draft, latest_release_prerelease, latest_release_reuse_unchanged, travis_url, travis_branch, travis_commit, travis_build_number, travis_build_id):
     tag_name = 'ci-{}-latest'.format(travis_branch)
     print('* Starting the procedure of creating/updating a latest release with tag name "{}".'.format(tag_name))
 
-    def there_is_a_newer_build_for_this_branch():
-      if int(Travis.github_auth(github_token, travis_api_url).branch_last_build_number(travis_repo_slug, travis_branch)) != int(travis_build_number):
-          print('Not creating/updating the "{}" release because there is a newer build for "{}" branch running on Travis-CI.'.format(tag_name, travis_branch))
-          print('We would either overwrite the artifacts uploaded by the newer build or mess up the release due to a race condition of both builds updating the release at the same time.')
-          return True
-      return False
+    def report_newer_build():
+        print('Not creating/updating the "{}" release because build #{} of "{}" branch has already taken it over.'.format(tag_name, lease.newer_build_number, travis_branch))
+        print('We would either overwrite the artifacts uploaded by the newer build or mess up the release due to a race condition of both builds updating the release at the same time.')
 
-    if there_is_a_newer_build_for_this_branch():
-        return
+    lease = LatestReleaseLease(conn, travis_branch, travis_build_number)
+    with conn.metrics.span('acquire lease', 'github', branch=travis_branch):
+        acquired = lease.acquire()
+    if not acquired:
+        report_newer_build()
+        return None
+    previous_release = releases.latest(travis_branch)
+    if latest_release_reuse_unchanged and previous_release and previous_release.draft == latest_release_draft and previous_release.prerelease == latest_release_prerelease:
+        # GitHub has no way of copying assets between releases, so the only way to not re-upload unchanged artifacts is
+        # to keep the release they are in.
+        previous_manifest = fetch_manifest(conn, previous_release)
+        if previous_manifest and previous_manifest['artifacts'] == manifest['artifacts']:
+            print('All {} artifacts are identical to the ones in the existing "{}" release, keeping it instead of re-uploading them.'.format(
+                len(manifest['artifacts']), tag_name))
+            lease.release(previous_release.id)
+            return None
     tag_name_tmp = '_{}'.format(tag_name)
     print('Creating a draft release with tag name "{}".'.format(tag_name_tmp))
-    release = github.Github(login_or_token=github_token, base_url=github_api_url).get_repo(travis_repo_slug).create_git_release(
+    release = conn.create_release(
         tag=tag_name_tmp,
         name=latest_release_name if latest_release_name else
              'Latest CI build of {} branch'.format(travis_branch),
         message=latest_release_body if latest_release_body else
                 'This is an auto-generated release based on [Travis-CI build #{}]({}/{}/builds/{})'
-                .format(travis_build_id, travis_url, travis_repo_slug, travis_build_id),
+                .format(travis_build_id, travis_url, conn.travis_repo_slug, travis_build_id),
         draft=True,
         prerelease=latest_release_prerelease,
         target_commitish=travis_commit)
-    upload_artifacts(artifact_dir, release)
-    if there_is_a_newer_build_for_this_branch():
-        print('Deleting the "{}" draft release.'.format(tag_name_tmp))
-        release.delete_release()
-        return
-    previous_release = [r for r in releases if r.tag_name == tag_name]
-    if previous_release:
-        delete_release(previous_release[0], github_token, github_api_url, travis_repo_slug)
-    print('Changing the tag name from "{}" to "{}"{}.'.format(tag_name_tmp, tag_name, '' if latest_release_draft else ' and removing the draft flag'))
-    release.update_release(
-        name=release.title, message=release.body, draft=latest_release_draft, prerelease=latest_release_prerelease, tag_name=tag_name)
 
+    def finish(release):
+        if not lease.swap():
+            report_newer_build()
+            delete_release(conn, release)
+            return
+        # The lease knows the current latest release even if another build has replaced it since we listed the releases
+        current_release = previous_release
+        if lease.release_id is not None and (not previous_release or previous_release.id != lease.release_id):
+            current_release = conn.release_object({'id': lease.release_id, 'tag_name': tag_name, 'draft': latest_release_draft})
+        if current_release:
+            delete_release(conn, current_release)
+        if previous_release:
+            releases.remove(previous_release)
+        print('Changing the tag name from "{}" to "{}"{}.'.format(tag_name_tmp, tag_name, '' if latest_release_draft else ' and removing the draft flag'))
+        release = conn.update_release(
+            release, name=release.title, message=release.body, draft=latest_release_draft, prerelease=latest_release_prerelease, tag_name=tag_name)
+        lease.release(release.id)
+        releases.add(release)
+
+    return release, finish
 
-def publish_tag_release(releases, artifact_dir, tag_release_name, tag_release_body, tag_release_draft, tag_release_prerelease, github_token, github_api_url, travis_url, travis_repo_slug, travis_commit, travis_build_id, travis_tag):
+def start_tag_release(conn, releases, tag_release_name, tag_release_body, tag_release_draft, tag_release_prerelease, travis_url, travis_commit, travis_build_id, travis_tag):
     print('* Starting the procedure of creating a tag release.')
     if not travis_tag:
         print('No tag was pushed, skipping making a tag release.')
-        return
+        return None
     print('Tag "{}" was pushed.'.format(travis_tag))
     tag_name = travis_tag
-    if any(release.tag_name == tag_name for release in releases):
+    if tag_name in releases:
         raise CIReleasePublisherError('Release with tag name "{}" already exists. Was this job restarted? We don\'t support restarts.'.format(tag_name))
     print('Creating a draft release with tag name "{}".'.format(tag_name))
-    release = github.Github(login_or_token=github_token, base_url=github_api_url).get_repo(travis_repo_slug).create_git_release(
+    release = conn.create_release(
         tag=tag_name,
         name=tag_release_name if tag_release_name else tag_name,
         message=tag_release_body if tag_release_body else
                 'This is an auto-generated release based on [Travis-CI build #{}]({}/{}/builds/{})'
-                .format(travis_build_id, travis_url, travis_repo_slug, travis_build_id),
+                .format(travis_build_id, travis_url, conn.travis_repo_slug, travis_build_id),
         draft=True,
         prerelease=tag_release_prerelease,
         target_commitish=travis_commit)
-    upload_artifacts(artifact_dir, release)
-    if not tag_release_draft:
-        print('Removing the draft flag from the "{}" release.'.format(tag_name))
-        release.update_release(name=release.title, message=release.body, draft=tag_release_draft, prerelease=tag_release_prerelease)
+    releases.add(release)
+
+    def finish(release):
+        if not tag_release_draft:
+            print('Removing the draft flag from the "{}" release.'.format(tag_name))
+            releases.remove(release)
+            release = conn.update_release(release, name=release.title, message=release.body, draft=tag_release_draft, prerelease=tag_release_prerelease)
+            releases.add(release)
+
+    return release, finish
+
+# Uploads the artifacts to all of the started releases in a single pass, reading each artifact once, and then finishes
+# all of the releases at the same time, so that they become available at about the same moment.
+def publish_releases(conn, started_releases, artifact_dir, upload_jobs, upload_retries, manifest):
+    started_releases = [started for started in started_releases if started]
+    if not started_releases:
+        return
+    try:
+        upload_artifacts(conn, artifact_dir, [release for release, _ in started_releases], upload_jobs, upload_retries, manifest)
+        finish_releases(conn, started_releases)
+    finally:
+        abort_releases(started_releases)
+
+def finish_releases(conn, started_releases):
+    start_time = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(started_releases)) as executor:
+        list(executor.map(lambda started: started[1](started[0]), started_releases))
+    conn.metrics.add_span('finish releases', 'phase', start_time, time.time() - start_time, {'releases': len(started_releases)})
+
+# Checks the release options of publish and deploy commands
+def check_release_args(latest_release, numbered_release, numbered_release_keep_count, numbered_release_keep_time, numbered_release_patches,
+                       numbered_release_patch_jobs, numbered_release_patch_level, tag_release):
+    if not latest_release and not numbered_release and not tag_release:
+        raise CIReleasePublisherError('You must specify what kind of release you would like to publish.')
+    if numbered_release:
+        if numbered_release_keep_count < 0:
+            raise CIReleasePublisherError('--numbered-release-keep-count can\'t be set to a negative number.')
+        if numbered_release_keep_time < 0:
+            raise CIReleasePublisherError('--numbered-release-keep-time can\'t be set to a negative number.')
+        if numbered_release_keep_count == 0 and numbered_release_keep_time == 0:
+            raise CIReleasePublisherError('You must specify at least one of --numbered-release-keep-* options specifying the strategy for keeping numbered builds.')
+        if numbered_release_patches and not zstandard:
+            raise CIReleasePublisherError('--numbered-release-patches requires "zstandard" Python package to be installed.')
+        if numbered_release_patch_jobs < 1:
+            raise CIReleasePublisherError('--numbered-release-patch-jobs must be at least 1.')
+        if not 1 <= numbered_release_patch_level <= 22:
+            raise CIReleasePublisherError('--numbered-release-patch-level must be from 1 to 22.')
+
+# Starts the releases the options ask for, returning them as a list of (release, finish) like start_*_release() do.
+# A tag release is made only for a pushed tag, while numbered and latest releases are made only for a pushed branch.
+def start_releases(conn, releases, manifest, artifact_dir, download_jobs, download_retries, upload_jobs, upload_retries, delete_jobs,
+                   latest_release, latest_release_name, latest_release_body, latest_release_draft, latest_release_prerelease, latest_release_reuse_unchanged,
+                   numbered_release, numbered_release_keep_count, numbered_release_keep_time, numbered_release_name, numbered_release_body,
+                   numbered_release_draft, numbered_release_prerelease, numbered_release_patches, numbered_release_patch_jobs, numbered_release_patch_level,
+                   tag_release, tag_release_name, tag_release_body, tag_release_draft, tag_release_prerelease,
+                   travis_url, travis_branch, travis_commit, travis_build_number, travis_build_id, travis_tag):
+    started_releases = []
+    # A release failing to start must not leave the background work of the already started ones running
+    try:
+        if travis_tag:
+            if tag_release:
+                started_releases.append(start_tag_release(conn, releases, tag_release_name, tag_release_body, tag_release_draft, tag_release_prerelease,
+                                                          travis_url, travis_commit, travis_build_id, travis_tag))
+        else:
+            if numbered_release:
+                started_numbered_release = start_numbered_release(conn, releases, delete_jobs, numbered_release_keep_count, numbered_release_keep_time,
+                                                                  numbered_release_name, numbered_release_body, numbered_release_draft, numbered_release_prerelease,
+                                                                  travis_url, travis_branch, travis_commit, travis_build_number, travis_build_id)
+                if numbered_release_patches:
+                    started_numbered_release = start_numbered_release_patches(conn, releases, started_numbered_release, manifest, artifact_dir,
+                                                                              download_jobs, download_retries, upload_jobs, upload_retries,
+                                                                              numbered_release_patch_jobs, numbered_release_patch_level,
+                                                                              travis_branch, travis_build_number)
+                started_releases.append(started_numbered_release)
+            if latest_release:
+                started_releases.append(start_latest_release(conn, releases, manifest, latest_release_name, latest_release_body, latest_release_draft,
+                                                             latest_release_prerelease, latest_release_reuse_unchanged, travis_url, travis_branch,
+                                                             travis_commit, travis_build_number, travis_build_id))
+    except BaseException:
+        abort_releases(started_releases)
+        raise
+    return started_releases
+
+# Publishes the artifacts stored by the jobs of this build and then deletes the stored releases, doing what collect,
+# publish and cleanup do in a single run that shares the connection and the release index between the phases.
+#
+# When the artifacts don't need to be on the disk, i.e. no `artifact_dir` is given and all of the stored releases have
+# manifests to verify the artifacts against and no bundles to unpack, each artifact is streamed from the stored release
+# straight into the uploads to the published releases. Otherwise the artifacts are collected into `artifact_dir`, or a
+# temporary directory, and published from there. `start_releases(manifest, artifact_dir)` starts the releases to publish
+# and returns them, e.g. start_releases() with all but these arguments bound, `artifact_dir` being None when streaming. Returns the manifest of the
+# published artifacts along with the started releases.
+def deploy(conn, releases, start_releases, artifact_dir, download_jobs, download_retries, upload_jobs, upload_retries, delete_jobs,
+           travis_branch, travis_build_number, travis_tag, stream=True):
+    releases_stored = stored_releases(releases, travis_branch, travis_build_number)
+    if not releases_stored:
+        raise CIReleasePublisherError('Couldn\'t find any draft releases with stored build artifacts for this build.')
+    print('Deploying artifacts from {} releases: {}.'.format(len(releases_stored), ', '.join('"{}"'.format(r.tag_name) for r in releases_stored)))
+    stored_assets = stored_release_assets(conn, releases_stored)
+    stored, bundle_chunks = stored_assets
+    # Streaming needs a hash to verify each artifact against, and bundles need to be unpacked on the disk
+    if bundle_chunks or any(sha256 is None for _, _, sha256 in stored.values()):
+        stream = False
+    if stream and not artifact_dir:
+        manifest = {
+            'algorithm': 'sha256',
+            'artifacts': {name: {'sha256': sha256, 'size': asset.size} for name, (_, asset, sha256) in stored.items()},
+        }
+        started_releases = [started for started in start_releases(manifest, None) if started]
+        if started_releases:
+            print('Streaming {} artifacts from the stored releases to {}.'.format(
+                len(stored), ', '.join('"{}"'.format(release.tag_name) for release, _ in started_releases)))
+            sources = [(name, asset.size, functools.partial(ReleaseAssetReader, conn, asset, sha256)) for name, (_, asset, sha256) in sorted(stored.items())]
+            try:
+                upload_sources(conn, sources, [release for release, _ in started_releases], upload_jobs, upload_retries, manifest)
+                finish_releases(conn, started_releases)
+            finally:
+                abort_releases(started_releases)
+    else:
+        with contextlib.ExitStack() as stack:
+            if not artifact_dir:
+                artifact_dir = stack.enter_context(tempfile.TemporaryDirectory())
+            os.makedirs(artifact_dir, exist_ok=True)
+            download_artifacts(conn, releases_stored, artifact_dir, download_jobs, download_retries, stored_assets)
+            manifest = artifacts_manifest(artifact_files(artifact_dir), upload_jobs)
+            started_releases = [started for started in start_releases(manifest, artifact_dir) if started]
+            publish_releases(conn, started_releases, artifact_dir, upload_jobs, upload_retries, manifest)
+    # The stored releases are deleted only once they are published, so that a failed deploy can be restarted
+    cleanup_draft_releases(conn, releases, delete_jobs, False, travis_branch, travis_build_number, travis_tag)
+    return manifest, started_releases
+
+# Returns a static index entry of a published release, reusing the entry of the previous index if the release and its
+# assets haven't changed, so that only new releases need their manifest fetched. `manifests` maps ids of the releases
+# whose manifest is already known, e.g. because they were just published, to their manifest.
+def release_index_entry(conn, release, kind, branch, build_number, previous_entry, manifests):
+    # Listed releases come with their assets, so there is no need to list them separately
+    all_assets = release.raw_data.get('assets', [])
+    assets = [asset for asset in all_assets if asset['name'] not in (MANIFEST_NAME, PATCH_MANIFEST_NAME)]
+    if previous_entry and previous_entry['id'] == release.id and \
+       sorted(asset['id'] for asset in previous_entry['assets']) == sorted(asset['id'] for asset in assets):
+        return previous_entry
+    if release.id in manifests:
+        manifest = manifests[release.id]
+    else:
+        manifest = fetch_manifest(conn, release, [github.GitReleaseAsset.GitReleaseAsset(conn.repo._requester, {}, asset, completed=True) for asset in all_assets])
+    artifacts = manifest['artifacts'] if manifest else {}
+    return {
+        'id': release.id,
+        'tag_name': release.tag_name,
+        'kind': kind,
+        'branch': branch,
+        'build_number': build_number,
+        'name': release.title,
+        'prerelease': release.prerelease,
+        'published_at': release.raw_data.get('published_at'),
+        'html_url': release.html_url,
+        'assets': sorted([{
+            'id': asset['id'],
+            'name': asset['name'],
+            'size': asset['size'],
+            # Releases made by older versions of this script have no manifest
+            'sha256': artifacts[asset['name']]['sha256'] if asset['name'] in artifacts and artifacts[asset['name']]['size'] == asset['size'] else None,
+            'url': asset['browser_download_url'],
+        } for asset in assets], key=lambda asset: asset['name']),
+    }
+
+# Returns the entries of the previous release index by tag name, read from `json_path` or, if there is no such file,
+# e.g. on a fresh CI machine, fetched from `url` where the previous index was published. Returns no entries if there
+# is no valid previous index, so that the index is made from scratch.
+def previous_release_index_entries(conn, json_path, url):
+    try:
+        if json_path and os.path.isfile(json_path):
+            source = json_path
+            with open(json_path) as f:
+                index = json.load(f)
+        elif url:
+            source = url
+            # It's a static file of the published site, not the GitHub API, so no credentials are sent along
+            response = conn.session.get(url)
+            if response.status_code == 404:
+                print('There is no previous release index at "{}", making it from scratch.'.format(url))
+                return {}
+            response.raise_for_status()
+            index = response.json()
+        else:
+            return {}
+        return {entry['tag_name']: entry for entry in index['releases']}
+    except (requests.exceptions.RequestException, ValueError, KeyError, TypeError) as e:
+        print('Warning: ignoring the previous release index "{}" as it couldn\'t be read: {}'.format(source, e))
+        return {}
+
+# Writes a static index of all published latest, numbered and tag releases with their assets as compact JSON and/or as
+# a Pelican page, so that finding a CI build takes a single fetch of a static file instead of walking the paginated
+# and rate limited releases API. The previous index, if any, is updated incrementally, see previous_release_index_entries().
+def update_release_index(conn, releases, json_path, page_path, manifests, previous_url=None):
+    start_time = time.time()
+    previous_entries = previous_release_index_entries(conn, json_path, previous_url)
+    entries = []
+    for release in releases:
+        if release.draft:
+            continue
+        keys = [key for key in ReleaseIndex.parse_tag_name(release.tag_name) if key[0] != 'stored']
+        if release.tag_name.startswith('_ci-') or (release.tag_name.startswith('ci-') and not keys):
+            continue
+        # Tag names like "ci-a-latest" or "ci-a-1" can't be the name of a tag release, as the CI doesn't build ci-* tags
+        kind, branch, build_number, _ = keys[0] if keys else ('tag', None, None, None)
+        entries.append(release_index_entry(conn, release, kind, branch, build_number, previous_entries.get(release.tag_name), manifests))
+    kind_order = ['latest', 'numbered', 'tag']
+    entries.sort(key=lambda entry: (kind_order.index(entry['kind']), entry['branch'] or '', -(entry['build_number'] or 0), entry['tag_name']))
+    reused = sum(1 for entry in entries if previous_entries.get(entry['tag_name']) is entry)
+    index = {
+        'repository': conn.travis_repo_slug,
+        'updated_at': datetime.datetime.utcnow().replace(microsecond=0).isoformat() + 'Z',
+        'releases': entries,
+    }
+    if json_path:
+        os.makedirs(os.path.dirname(os.path.abspath(json_path)), exist_ok=True)
+        with open(json_path, 'w') as f:
+            json.dump(index, f, sort_keys=True, separators=(',', ':'))
+    if page_path:
+        os.makedirs(os.path.dirname(os.path.abspath(page_path)), exist_ok=True)
+        with open(page_path, 'w') as f:
+            f.write(release_index_page(index, os.path.relpath(json_path, os.path.dirname(os.path.abspath(page_path))) if json_path else None))
+    conn.metrics.add_span('update release index', 'phase', start_time, time.time() - start_time, {'releases': len(entries), 'reused': reused})
+    print('Updated the release index of {} releases, {} of them unchanged, in {:.2f} seconds.'.format(len(entries), reused, time.time() - start_time))
+
+# Updates the release index, if asked to, reusing the manifest of the just published releases
+def update_index(conn, releases, started_releases, manifest, release_index_json, release_index_page, release_index_url):
+    if release_index_json or release_index_page:
+        # Release ids don't change when the releases are renamed
+        manifests = {started[0].id: manifest for started in started_releases if started}
+        update_release_index(conn, releases, release_index_json, release_index_page, manifests, release_index_url)
+
+# Returns a Pelican Markdown page listing the releases of an index
+def release_index_page(index, json_link=None):
+    lines = [
+        'Title: CI builds',
+        'Slug: ci-builds',
+        'Modified: {}'.format(index['updated_at'].replace('T', ' ').rstrip('Z')),
+        '',
+        'Builds of [{0}](https://github.com/{0}) published by Travis-CI.'.format(index['repository']),
+    ]
+    if json_link:
+        lines.append('The same list is available as [JSON]({{filename}}{}).'.format(json_link.replace(os.sep, '/')))
+    headings = {'latest': 'Latest builds', 'numbered': 'Numbered builds', 'tag': 'Tagged releases'}
+    for kind in ['latest', 'numbered', 'tag']:
+        entries = [entry for entry in index['releases'] if entry['kind'] == kind]
+        if not entries:
+            continue
+        lines.extend(['', '## {}'.format(headings[kind])])
+        for entry in entries:
+            lines.extend([
+                '',
+                '### [{}]({})'.format(entry['name'] or entry['tag_name'], entry['html_url']),
+                '',
+                ' '.join(filter(None, [
+                    'Branch `{}`.'.format(entry['branch']) if entry['branch'] else None,
+                    'Published at {}.'.format(entry['published_at'].replace('T', ' ').rstrip('Z')) if entry['published_at'] else None,
+                    'Pre-release.' if entry['prerelease'] else None,
+                ])),
+                '',
+                '| Artifact | Size | SHA-256 |',
+                '| --- | ---: | --- |',
+            ])
+            lines.extend('| [{}]({}) | {:.1f} MiB | `{}` |'.format(asset['name'], asset['url'], asset['size']/1024/1024, asset['sha256'] or 'unknown')
+                         for asset in entry['assets'])
+    return '\n'.join(lines) + '\n'
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='CI release publisher for GitHub+Travis-CI.')
@@ -329,6 +2314,40 @@ if __name__ == "__main__":
     parser.add_argument('--github-api-url', type=str, default="",
                         help='Use custom GitHib API URL, e.g. for self-hosted GitHub Enterprise instance. This should be an URL to the API endpoint, e.g. "https://api.github.com".')
 
+    parser.add_argument('--cache-dir', type=str,
+                        help='Directory to cache GitHub and Travis-CI API responses in. Cached responses are revalidated with conditional requests, '
+                             'so only the changed data is transferred and unchanged GitHub responses don\'t count against the rate limit. '
+                             'Point it to a directory preserved between the builds, e.g. using Travis-CI\'s cache feature.')
+    parser.add_argument('--cache-ttl', type=int, default=24*60*60,
+                        help='Number of seconds after which a cached API response that wasn\'t used gets evicted from the cache.')
+    parser.add_argument('--metrics-json', type=str,
+                        help='Write a JSON report with timings of the API calls and transfers, request and byte counters, retries and remaining rate limits to this file at exit.')
+    parser.add_argument('--trace-json', type=str,
+                        help='Write timings of the API calls and transfers to this file at exit, in Chrome\'s trace event format. '
+                             'Open it in chrome://tracing or https://ui.perfetto.dev.')
+    parser.add_argument('--upload-jobs', type=int, default=1,
+                        help='Number of artifacts to upload concurrently. Applies to "store" and "publish" commands.')
+    parser.add_argument('--upload-retries', type=int, default=3,
+                        help='Number of times to retry a failed artifact upload, with an exponential backoff between the attempts.')
+
+    parser.add_argument('--download-jobs', type=int, default=1,
+                        help='Number of artifacts to download concurrently. Applies to "collect" command.')
+    parser.add_argument('--download-retries', type=int, default=3,
+                        help='Number of times to retry a failed artifact download. Each retry resumes the download where the previous attempt has stopped.')
+
+    parser.add_argument('--delete-jobs', type=int, default=4,
+                        help='Number of releases to delete concurrently. Applies to "cleanup" and "publish" commands. '
+                             'Keep it low, GitHub rate limits bursts of content-modifying requests.')
+    parser.add_argument('--request-rate', type=float, default=10.0,
+                        help='Maximum number of API requests per second to a single host. The rate is lowered automatically when getting rate limited '
+                             'or running low on the remaining rate limit.')
+    parser.add_argument('--request-retries', type=int, default=3,
+                        help='Number of times to retry an API request that has failed due to a server or connection error. '
+                             'Rate limited requests are retried after the delay the server asks for.')
+    parser.add_argument('--scheduler-state-file', type=str,
+                        help='File to share the request rate budget through with other instances of this script running on the same host. '
+                             'The file is locked while being updated. Not supported on Windows.')
+
     subparsers = parser.add_subparsers(dest='command')
 
     # store subparser
@@ -336,60 +2355,125 @@ if __name__ == "__main__":
     parser_store.add_argument('artifact_dir', metavar='artifact-dir', help='Path to a direcotry containing artifacts that need to be stored.')
     parser_store.add_argument('--release-name', type=str, help='Release name text. If not specified a predefined text is used.')
     parser_store.add_argument('--release-body', type=str, help='Release body text. If not specified a predefined text is used.')
+    parser_store.add_argument('--bundle', type=str, choices=sorted(BUNDLE_COMPRESSIONS.keys()),
+                              help='Store the artifacts as a single compressed tar archive, split into chunks, instead of one by one. '
+                                   'It\'s faster for many small artifacts and saves bandwidth on compressible ones. "collect" unpacks it automatically. '
+                                   'zstd compression requires "zstandard" Python package.')
+    parser_store.add_argument('--bundle-chunk-size', type=int, default=512,
+                              help='Maximum size of a bundle chunk, in MiB. Chunks are uploaded concurrently with --upload-jobs.')
 
     # collect subparser
     parser_collect = subparsers.add_parser('collect', help='Collect the previously stored build artifacts in a directory.')
     parser_collect.add_argument('artifact_dir', metavar='artifact-dir', help='Path to a direcotry where artifacts should be collected to.')
+    parser_collect.add_argument('--wait', dest='wait', action='store_true',
+                                help='Wait for the other jobs of this build stage and earlier stages to finish, downloading the artifacts of each job as soon as it has '
+                                     'finished, while the other jobs are still running. Requires TRAVIS_BUILD_ID and TRAVIS_JOB_NUMBER environment variables.')
+    parser_collect.set_defaults(wait=False)
+    parser_collect.add_argument('--wait-timeout', type=int, default=3600,
+                                help='How long to wait for the jobs to finish, in seconds. The jobs that haven\'t finished by then are listed and collect fails.')
+    parser_collect.add_argument('--poll-interval', type=float, default=10,
+                                help='How often to check the job states on Travis-CI, in seconds. The interval grows up to 6 times that while no job finishes.')
 
     # cleanup subparser
-    parser_collect = subparsers.add_parser('cleanup',
+    parser_cleanup = subparsers.add_parser('cleanup',
                                            help='Delete all draft releases created by this script during the "store" phase of this and previous (finished) builds. '
                                                 'Only the releases for the current branch are considered.')
+    parser_cleanup.add_argument('--dry-run', dest='dry_run', action='store_true', help='Only print which releases would be deleted, without deleting them.')
+    parser_cleanup.set_defaults(dry_run=False)
+
+    # gc subparser
+    parser_gc = subparsers.add_parser('gc',
+                                      help='Delete CI releases and tags that are no longer needed across all branches: releases stored by finished builds, '
+                                           'temporary releases and tags left behind by crashed runs and numbered releases exceeding the retention policy. '
+                                           'Doesn\'t need to run as a part of a build, only GITHUB_ACCESS_TOKEN and TRAVIS_REPO_SLUG environment variables are required.')
+    parser_gc.add_argument('--dry-run', dest='dry_run', action='store_true', help='Only print which releases and tags would be deleted, without deleting them.')
+    parser_gc.add_argument('--keep-count', type=int, default=0,
+                           help='Number of numbered releases to keep per branch. If set to 0, this check is disabled.')
+    parser_gc.add_argument('--keep-time', type=int, default=0,
+                           help='How long to keep the numbered releases for, in seconds. If set to 0, this check is disabled.')
+    parser_gc.add_argument('--delete-stale-branches', dest='delete_stale_branches', action='store_true',
+                           help='Also delete numbered and latest releases of branches that no longer exist.')
+    parser_gc.set_defaults(dry_run=False, delete_stale_branches=False)
+
+    # Release options shared by publish and deploy subparsers
+    parser_releases = argparse.ArgumentParser(add_help=False)
+    # publish and deploy subparsers -- latest release
+    parser_releases.add_argument('--latest-release', dest='latest_release', action='store_true',
+                                 help='Publish latest release. The same "ci-<branch>-latest" tag release will be re-used (re-created) by each build.')
+    parser_releases.set_defaults(latest_release=False)
+    parser_releases.add_argument('--latest-release-name', type=str, help='Release name text. If not specified a predefined text is used.')
+    parser_releases.add_argument('--latest-release-body', type=str, help='Release body text. If not specified a predefined text is used.')
+    parser_releases.add_argument('--latest-release-draft', dest='latest_release_draft', action='store_true', help='Publish as a draft.')
+    parser_releases.set_defaults(latest_release_draft=False)
+    parser_releases.add_argument('--latest-release-prerelease', dest='latest_release_prerelease', action='store_true', help='Publish as a prerelease.')
+    parser_releases.set_defaults(latest_release_prerelease=False)
+    parser_releases.add_argument('--latest-release-reuse-unchanged', dest='latest_release_reuse_unchanged', action='store_true',
+                                 help='Keep the existing latest release instead of re-creating it if all artifacts are identical to the ones in it, '
+                                      'as determined by the SHA-256 hashes in its manifest. The kept release keeps pointing to the commit of the build that made it.')
+    parser_releases.set_defaults(latest_release_reuse_unchanged=False)
+
+    # publish and deploy subparsers -- numbered release
+    parser_releases.add_argument('--numbered-release', dest='numbered_release', action='store_true',
+                                 help='Publish a numbered release. A separate "ci-<branch>-<build_number>" tag release will be made for each build. '
+                                      'You must specify at least one of --numbered-release-keep-* arguments specifying the strategy for keeping numbered builds.')
+    parser_releases.set_defaults(numbered_release=False)
+    parser_releases.add_argument('--numbered-release-keep-count', type=int, default=0,
+                                 help='Number of numbered releases to keep. If set to 0, this check is disabled, otherwise if the number of numbered releases exceeds that number, '
+                                      'the oldest numbered release will be deleted. Note that due to a race condition of several Travis-CI builds running at the same time, '
+                                      'although unlikely, it\'s possible for the number of kept numbered releases to exceed that number by the number of concurrent Travis-CI builds running.')
+    parser_releases.add_argument('--numbered-release-keep-time', type=int, default=0,
+                                 help='How long to keep the numbered releases for, in seconds. If set to 0, this check is disabled, '
+                                      'otherwise all numbered releases that are older than the specified amount of seconds will be deleted.')
+    parser_releases.add_argument('--numbered-release-name', type=str, help='Release name text. If not specified a predefined text is used.')
+    parser_releases.add_argument('--numbered-release-body', type=str, help='Release body text. If not specified a predefined text is used.')
+    parser_releases.add_argument('--numbered-release-draft', dest='numbered_release_draft', action='store_true', help='Publish as a draft.')
+    parser_releases.set_defaults(numbered_release_draft=False)
+    parser_releases.add_argument('--numbered-release-prerelease', dest='numbered_release_prerelease', action='store_true', help='Publish as a prerelease.')
+    parser_releases.set_defaults(numbered_release_prerelease=False)
+    parser_releases.add_argument('--numbered-release-patches', dest='numbered_release_patches', action='store_true',
+                                 help='Also upload a binary delta patch of each changed artifact from the same-named asset of the previous numbered release, '
+                                      'named "<artifact>.patch-from-<build_number>.zst" and described in "{}". The patches are zstd frames that '
+                                      '"zstd -d --long=31 --patch-from=<previous artifact>" turns back into the artifact. The previous numbered release is picked '
+                                      'after --numbered-release-keep-* have deleted the old ones, so there are no patches with --numbered-release-keep-count 1. '
+                                      'Requires "zstandard" Python package.'.format(PATCH_MANIFEST_NAME))
+    parser_releases.set_defaults(numbered_release_patches=False)
+    parser_releases.add_argument('--numbered-release-patch-jobs', type=int, default=2,
+                                 help='Number of processes making the patches. Each process needs memory of about 10 times the size of the artifact it makes a patch of.')
+    parser_releases.add_argument('--numbered-release-patch-level', type=int, default=9, help='zstd compression level of the patches, from 1 to 22.')
+
+    # publish and deploy subparsers -- tag release
+    parser_releases.add_argument('--tag-release', dest='tag_release', action='store_true',
+                                 help='Publish a release for a pushed tag. A separate "<tag>" release will be made whenever a tag is pushed.')
+    parser_releases.set_defaults(tag_release=False)
+    parser_releases.add_argument('--tag-release-name', type=str, help='Release name text.  If not specified a predefined text is used.')
+    parser_releases.add_argument('--tag-release-body', type=str, help='Release body text.  If not specified a predefined text is used.')
+    parser_releases.add_argument('--tag-release-draft', dest='tag_release_draft', action='store_true', help='Publish as a draft.')
+    parser_releases.set_defaults(tag_release_draft=False)
+    parser_releases.add_argument('--tag-release-prerelease', dest='tag_release_prerelease', action='store_true', help='Publish as a prerelease.')
+    parser_releases.set_defaults(tag_release_prerelease=False)
+    # Release index
+    parser_releases.add_argument('--release-index-json', type=str,
+                                 help='Write a compact JSON index of all published latest, numbered and tag releases with their assets, sizes, SHA-256 hashes and '
+                                      'download URLs into this file. If the file exists, it\'s updated incrementally, only new releases need their manifest fetched. '
+                                      'E.g. "content/ci/releases.json" of the Pelican site.')
+    parser_releases.add_argument('--release-index-page', type=str,
+                                 help='Write a Pelican Markdown page listing the same releases into this file, e.g. "content/pages/ci-builds.en.md".')
+    parser_releases.add_argument('--release-index-url', type=str,
+                                 help='URL of the previously published --release-index-json, e.g. "https://<owner>.github.io/<repo>/ci/releases.json". '
+                                      'When there is no --release-index-json file yet, as on a fresh CI machine, the previous index is fetched from it, so that '
+                                      'only new releases need their manifest fetched.')
 
     # publsh subparser
-    parser_publish = subparsers.add_parser('publish', help='Publish a release with all artifacts from a directory.')
+    parser_publish = subparsers.add_parser('publish', parents=[parser_releases], help='Publish a release with all artifacts from a directory.')
     parser_publish.add_argument('artifact_dir', metavar='artifact-dir', help='Path to a direcotry containing build artifacts to publish.')
 
-    # publsh subparser -- latest release
-    parser_publish.add_argument('--latest-release', dest='latest_release', action='store_true',
-                                help='Publish latest release. The same "ci-<branch>-latest" tag release will be re-used (re-created) by each build.')
-    parser_publish.set_defaults(latest_release=False)
-    parser_publish.add_argument('--latest-release-name', type=str, help='Release name text. If not specified a predefined text is used.')
-    parser_publish.add_argument('--latest-release-body', type=str, help='Release body text. If not specified a predefined text is used.')
-    parser_publish.add_argument('--latest-release-draft', dest='latest_release_draft', action='store_true', help='Publish as a draft.')
-    parser_publish.set_defaults(latest_release_draft=False)
-    parser_publish.add_argument('--latest-release-prerelease', dest='latest_release_prerelease', action='store_true', help='Publish as a prerelease.')
-    parser_publish.set_defaults(latest_release_prerelease=False)
-
-    # publsh subparser -- numbered release
-    parser_publish.add_argument('--numbered-release', dest='numbered_release', action='store_true',
-                                help='Publish a numbered release. A separate "ci-<branch>-<build_number>" tag release will be made for each build. '
-                                     'You must specify at least one of --numbered-release-keep-* arguments specifying the strategy for keeping numbered builds.')
-    parser_publish.set_defaults(numbered_release=False)
-    parser_publish.add_argument('--numbered-release-keep-count', type=int, default=0,
-                                help='Number of numbered releases to keep. If set to 0, this check is disabled, otherwise if the number of numbered releases exceeds that number, '
-                                     'the oldest numbered release will be deleted. Note that due to a race condition of several Travis-CI builds running at the same time, '
-                                     'although unlikely, it\'s possible for the number of kept numbered releases to exceed that number by the number of concurrent Travis-CI builds running.')
-    parser_publish.add_argument('--numbered-release-keep-time', type=int, default=0,
-                                help='How long to keep the numbered releases for, in seconds. If set to 0, this check is disabled, '
-                                     'otherwise all numbered releases that are older than the specified amount of seconds will be deleted.')
-    parser_publish.add_argument('--numbered-release-name', type=str, help='Release name text. If not specified a predefined text is used.')
-    parser_publish.add_argument('--numbered-release-body', type=str, help='Release body text. If not specified a predefined text is used.')
-    parser_publish.add_argument('--numbered-release-draft', dest='numbered_release_draft', action='store_true', help='Publish as a draft.')
-    parser_publish.set_defaults(numbered_release_draft=False)
-    parser_publish.add_argument('--numbered-release-prerelease', dest='numbered_release_prerelease', action='store_true', help='Publish as a prerelease.')
-    parser_publish.set_defaults(numbered_release_prerelease=False)
-
-    # publsh subparser -- tag release
-    parser_publish.add_argument('--tag-release', dest='tag_release', action='store_true',
-                                help='Publish a release for a pushed tag. A separate "<tag>" release will be made whenever a tag is pushed.')
-    parser_publish.set_defaults(tag_release=False)
-    parser_publish.add_argument('--tag-release-name', type=str, help='Release name text.  If not specified a predefined text is used.')
-    parser_publish.add_argument('--tag-release-body', type=str, help='Release body text.  If not specified a predefined text is used.')
-    parser_publish.add_argument('--tag-release-draft', dest='tag_release_draft', action='store_true', help='Publish as a draft.')
-    parser_publish.set_defaults(tag_release_draft=False)
-    parser_publish.add_argument('--tag-release-prerelease', dest='tag_release_prerelease', action='store_true', help='Publish as a prerelease.')
-    parser_publish.set_defaults(tag_release_prerelease=False)
+    # deploy subparser
+    parser_deploy = subparsers.add_parser('deploy', parents=[parser_releases],
+                                          help='Do what "collect", "publish" and "cleanup" do in a single run: publish the artifacts stored by the jobs of this build and '
+                                               'then delete the releases they were stored in. The artifacts are streamed from the stored releases into the published ones, '
+                                               'without going through the disk, unless --artifact-dir or --numbered-release-patches is given.')
+    parser_deploy.add_argument('--artifact-dir', type=str,
+                               help='Collect the artifacts into this directory and publish them from there instead of streaming them, e.g. to keep them for later.')
 
     args = parser.parse_args()
 
@@ -417,60 +2501,122 @@ if __name__ == "__main__":
             return None
         return os.environ[name]
 
+    def connect():
+        # publish uploads each artifact to both the numbered and the latest releases at the same time, and deploy
+        # downloads it from the stored release at the same time too
+        return Connection(required_env('GITHUB_ACCESS_TOKEN'), args.github_api_url, travis_api_url, required_env('TRAVIS_REPO_SLUG'),
+                          args.cache_dir, args.cache_ttl, max(3 * args.upload_jobs, args.download_jobs, args.delete_jobs),
+                          args.request_rate, args.request_retries, args.scheduler_state_file)
+
+    # Options of start_releases() given by the command line arguments and the environment
+    def release_options():
+        return dict(
+            download_jobs=args.download_jobs, download_retries=args.download_retries, upload_jobs=args.upload_jobs, upload_retries=args.upload_retries,
+            delete_jobs=args.delete_jobs, latest_release=args.latest_release, latest_release_name=args.latest_release_name,
+            latest_release_body=args.latest_release_body, latest_release_draft=args.latest_release_draft,
+            latest_release_prerelease=args.latest_release_prerelease, latest_release_reuse_unchanged=args.latest_release_reuse_unchanged,
+            numbered_release=args.numbered_release, numbered_release_keep_count=args.numbered_release_keep_count,
+            numbered_release_keep_time=args.numbered_release_keep_time, numbered_release_name=args.numbered_release_name,
+            numbered_release_body=args.numbered_release_body, numbered_release_draft=args.numbered_release_draft,
+            numbered_release_prerelease=args.numbered_release_prerelease, numbered_release_patches=args.numbered_release_patches,
+            numbered_release_patch_jobs=args.numbered_release_patch_jobs, numbered_release_patch_level=args.numbered_release_patch_level,
+            tag_release=args.tag_release, tag_release_name=args.tag_release_name, tag_release_body=args.tag_release_body,
+            tag_release_draft=args.tag_release_draft, tag_release_prerelease=args.tag_release_prerelease, travis_url=travis_url,
+            travis_branch=required_env('TRAVIS_BRANCH'), travis_commit=required_env('TRAVIS_COMMIT'),
+            travis_build_number=required_env('TRAVIS_BUILD_NUMBER'), travis_build_id=required_env('TRAVIS_BUILD_ID'), travis_tag=optional_env('TRAVIS_TAG'))
+
+    conn = None
     try:
+        if args.cache_ttl < 0:
+            raise CIReleasePublisherError('--cache-ttl can\'t be set to a negative number.')
+        if args.upload_jobs < 1:
+            raise CIReleasePublisherError('--upload-jobs must be at least 1.')
+        if args.upload_retries < 0:
+            raise CIReleasePublisherError('--upload-retries can\'t be set to a negative number.')
+        if args.download_jobs < 1:
+            raise CIReleasePublisherError('--download-jobs must be at least 1.')
+        if args.download_retries < 0:
+            raise CIReleasePublisherError('--download-retries can\'t be set to a negative number.')
+        if args.delete_jobs < 1:
+            raise CIReleasePublisherError('--delete-jobs must be at least 1.')
+        if args.request_rate <= 0:
+            raise CIReleasePublisherError('--request-rate must be a positive number.')
+        if args.request_retries < 0:
+            raise CIReleasePublisherError('--request-retries can\'t be set to a negative number.')
         if args.command == 'store':
             if not os.path.isdir(args.artifact_dir):
                 raise CIReleasePublisherError('Directory "{}" doesn\'t exist.'.format(args.artifact_dir))
-            store_artifacts(args.artifact_dir, args.release_name, args.release_body, required_env('GITHUB_ACCESS_TOKEN'),
-                            args.github_api_url, travis_url, required_env('TRAVIS_REPO_SLUG'), required_env('TRAVIS_BRANCH'),
+            if args.bundle_chunk_size < 1:
+                raise CIReleasePublisherError('--bundle-chunk-size must be at least 1.')
+            if args.bundle == 'zstd' and not zstandard:
+                raise CIReleasePublisherError('zstd compression requires "zstandard" Python package to be installed.')
+            conn = connect()
+            releases = fetch_release_index(conn)
+            store_artifacts(conn, releases, args.artifact_dir, args.upload_jobs, args.upload_retries, args.bundle, args.bundle_chunk_size*1024*1024, args.release_name, args.release_body,
+                            travis_url, required_env('TRAVIS_BRANCH'),
                             required_env('TRAVIS_COMMIT'), required_env('TRAVIS_BUILD_NUMBER'),
                             required_env('TRAVIS_JOB_NUMBER').split('.')[1], required_env('TRAVIS_JOB_ID'))
         elif args.command == 'collect':
             if not os.path.isdir(args.artifact_dir):
                 raise CIReleasePublisherError('Directory "{}" doesn\'t exist.'.format(args.artifact_dir))
-            collect_stored_artifacts(args.artifact_dir, required_env('GITHUB_ACCESS_TOKEN'), args.github_api_url,
-                                     required_env('TRAVIS_REPO_SLUG'), required_env('TRAVIS_BRANCH'),
-                                     required_env('TRAVIS_BUILD_NUMBER'))
+            if args.wait_timeout < 0:
+                raise CIReleasePublisherError('--wait-timeout can\'t be set to a negative number.')
+            if args.poll_interval <= 0:
+                raise CIReleasePublisherError('--poll-interval must be a positive number.')
+            conn = connect()
+            if args.wait:
+                collect_stored_artifacts_wait(conn, args.artifact_dir, args.download_jobs, args.download_retries, args.wait_timeout,
+                                              args.poll_interval, 6 * args.poll_interval, required_env('TRAVIS_BRANCH'),
+                                              required_env('TRAVIS_BUILD_NUMBER'), required_env('TRAVIS_BUILD_ID'), required_env('TRAVIS_JOB_NUMBER'))
+            else:
+                releases = fetch_release_index(conn)
+                collect_stored_artifacts(conn, releases, args.artifact_dir, args.download_jobs, args.download_retries,
+                                         required_env('TRAVIS_BRANCH'), required_env('TRAVIS_BUILD_NUMBER'))
         elif args.command == 'cleanup':
-            cleanup_draft_releases(required_env('GITHUB_ACCESS_TOKEN'), args.github_api_url, travis_api_url,
-                                   required_env('TRAVIS_REPO_SLUG'), required_env('TRAVIS_BRANCH'),
+            conn = connect()
+            releases = fetch_release_index(conn)
+            cleanup_draft_releases(conn, releases, args.delete_jobs, args.dry_run, required_env('TRAVIS_BRANCH'),
                                    required_env('TRAVIS_BUILD_NUMBER'), optional_env('TRAVIS_TAG'))
+        elif args.command == 'gc':
+            if args.keep_count < 0:
+                raise CIReleasePublisherError('--keep-count can\'t be set to a negative number.')
+            if args.keep_time < 0:
+                raise CIReleasePublisherError('--keep-time can\'t be set to a negative number.')
+            conn = connect()
+            releases = fetch_release_index(conn)
+            collect_garbage(conn, releases, args.delete_jobs, args.dry_run, args.keep_count, args.keep_time, args.delete_stale_branches)
         elif args.command == 'publish':
             if not os.path.isdir(args.artifact_dir):
                 raise CIReleasePublisherError('Directory "{}" doesn\'t exist.'.format(args.artifact_dir))
-            if not args.latest_release and not args.numbered_release and not args.tag_release:
-                raise CIReleasePublisherError('You must specify what kind of release you would like to publish.')
-            if args.numbered_release:
-                if args.numbered_release_keep_count < 0:
-                    raise CIReleasePublisherError('--numbered-release-keep-count can\'t be set to a negative number.')
-                if args.numbered_release_keep_time < 0:
-                    raise CIReleasePublisherError('--numbered-release-keep-time can\'t be set to a negative number.')
-                if args.numbered_release_keep_count == 0 and args.numbered_release_keep_time == 0:
-                    raise CIReleasePublisherError('You must specify at least one of --numbered-release-keep-* options specifying the strategy for keeping numbered builds.')
+            check_release_args(args.latest_release, args.numbered_release, args.numbered_release_keep_count, args.numbered_release_keep_time,
+                               args.numbered_release_patches, args.numbered_release_patch_jobs, args.numbered_release_patch_level, args.tag_release)
             if len(os.listdir(args.artifact_dir)) <= 0:
                 raise CIReleasePublisherError('No artifacts were found in "{}" directory.'.format(args.artifact_dir))
-            releases = github.Github(login_or_token=required_env('GITHUB_ACCESS_TOKEN'), base_url=args.github_api_url).get_repo(required_env('TRAVIS_REPO_SLUG')).get_releases()
-            if optional_env('TRAVIS_TAG'):
-                if args.tag_release:
-                    publish_tag_release(releases, args.artifact_dir, args.tag_release_name, args.tag_release_body, args.tag_release_draft,
-                                        args.tag_release_prerelease, required_env('GITHUB_ACCESS_TOKEN'), args.github_api_url,
-                                        travis_url, required_env('TRAVIS_REPO_SLUG'), required_env('TRAVIS_COMMIT'), required_env('TRAVIS_BUILD_ID'),
-                                        optional_env('TRAVIS_TAG'))
-            else:
-                if args.numbered_release:
-                    publish_numbered_release(releases, args.artifact_dir, args.numbered_release_keep_count, args.numbered_release_keep_time,
-                                            args.numbered_release_name, args.numbered_release_body, args.numbered_release_draft,
-                                            args.numbered_release_prerelease, required_env('GITHUB_ACCESS_TOKEN'), args.github_api_url,
-                                            travis_url, required_env('TRAVIS_REPO_SLUG'), required_env('TRAVIS_BRANCH'),
-                                            required_env('TRAVIS_COMMIT'), required_env('TRAVIS_BUILD_NUMBER'), required_env('TRAVIS_BUILD_ID'))
-                if args.latest_release:
-                    publish_latest_release(releases, args.artifact_dir, args.latest_release_name, args.latest_release_body,
-                                        args.latest_release_draft, args.latest_release_prerelease, required_env('GITHUB_ACCESS_TOKEN'),
-                                        args.github_api_url, travis_api_url, travis_url, required_env('TRAVIS_REPO_SLUG'),
-                                        required_env('TRAVIS_BRANCH'), required_env('TRAVIS_COMMIT'), required_env('TRAVIS_BUILD_NUMBER'),
-                                        required_env('TRAVIS_BUILD_ID'))
+            conn = connect()
+            releases = fetch_release_index(conn)
+            manifest = artifacts_manifest(artifact_files(args.artifact_dir), args.upload_jobs)
+            started_releases = start_releases(conn, releases, manifest, args.artifact_dir, **release_options())
+            publish_releases(conn, started_releases, args.artifact_dir, args.upload_jobs, args.upload_retries, manifest)
+            update_index(conn, releases, started_releases, manifest, args.release_index_json, args.release_index_page, args.release_index_url)
+        elif args.command == 'deploy':
+            check_release_args(args.latest_release, args.numbered_release, args.numbered_release_keep_count, args.numbered_release_keep_time,
+                               args.numbered_release_patches, args.numbered_release_patch_jobs, args.numbered_release_patch_level, args.tag_release)
+            conn = connect()
+            releases = fetch_release_index(conn)
+            manifest, started_releases = deploy(conn, releases, functools.partial(start_releases, conn, releases, **release_options()),
+                                                args.artifact_dir, args.download_jobs, args.download_retries,
+                                                args.upload_jobs, args.upload_retries, args.delete_jobs, required_env('TRAVIS_BRANCH'),
+                                                required_env('TRAVIS_BUILD_NUMBER'), optional_env('TRAVIS_TAG'), not args.numbered_release_patches)
+            update_index(conn, releases, started_releases, manifest, args.release_index_json, args.release_index_page, args.release_index_url)
         else:
-            raise CIReleasePublisherError('Specify one of "store", "collect", "cleanup" or "publish" commands.')
+            raise CIReleasePublisherError('Specify one of "store", "collect", "cleanup", "gc", "publish" or "deploy" commands.')
     except CIReleasePublisherError as e:
         print('Error: {}'.format(str(e)))
         sys.exit(1)
+    finally:
+        if conn and args.metrics_json:
+            conn.metrics.write_report(args.metrics_json)
+            print('Metrics are written to "{}".'.format(args.metrics_json))
+        if conn and args.trace_json:
+            conn.metrics.write_trace(args.trace_json)
+            print('Trace is written to "{}".'.format(args.trace_json))
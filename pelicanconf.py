@@ -31,6 +31,9 @@ SOCIAL = (('You can add links in your config file', '#'),
 
 DEFAULT_PAGINATION = False
 
+# ci/releases.json is the index of CI releases written by `ci_release_publisher.py publish --release-index-json`
+STATIC_PATHS = ['images', 'ci']
+
 # Uncomment following line if you want document-relative URLs when developing
 #RELATIVE_URLS = True
 